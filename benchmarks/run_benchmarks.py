@@ -0,0 +1,384 @@
+"""Time the genome build and query path on synthetic inputs and save the results as JSON.
+
+Everything runs offline: synthetic.py writes a small seeded KEGG snapshot, precalculated table, taxonomy and tree
+into --data_dir, a genome database is built from them and the web app is exercised through the Flask test
+client.  Each benchmark is timed --repeat times, then run once more under tracemalloc for its peak memory.
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --only flask_single_cold flask_pair --compare benchmarks/results/old.json
+"""
+import argparse
+import gc
+import gzip
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import synthetic
+from micrometab_analysis import community_metrics
+from micrometab_analysis import metabolic_network_analysis as mna
+from micrometab_analysis import parse_KEGG
+from micrometab_analysis import picrust_util as pu
+from micrometab_analysis.tree_distance import TreeDistance
+
+DATA_DIR = os.path.join(BENCH_DIR, "data")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+DB_NAME = "gg_genomes.db"
+repeat = 3
+sample = 100
+pairs = 200
+
+BENCHMARKS = list()
+
+
+def benchmark(name):
+    """register a benchmark, the function takes the Context and returns (run, items per run, item unit)"""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+class Context:
+    """inputs shared between benchmarks, each built the first time a benchmark asks for it"""
+    def __init__(self, data_dir, otus, sample_size, n_pairs, seed):
+        self.data_dir = data_dir
+        self.kegg_dir = os.path.join(data_dir, 'kegg') + os.sep
+        self.otus = otus
+        self.rnd = random.Random(seed)
+        self.sample = self.rnd.sample(otus, min(sample_size, len(otus)))
+        self.pairs = [tuple(self.rnd.sample(otus, 2)) for _ in range(n_pairs)]
+        self._genomes = None
+        self._networks = None
+        self._kb = None
+
+    @property
+    def genomes(self):
+        """KO list of each sampled OTU"""
+        if self._genomes is None:
+            table = pu.load_data_table(self.sample)
+            kos = table.ids(axis='observation')
+            self._genomes = [[str(i) for i in kos[table.data(otu) > 0]] for otu in self.sample]
+        return self._genomes
+
+    @property
+    def networks(self):
+        """(network, seed sets) of each sampled OTU"""
+        if self._networks is None:
+            index = mna.get_ko_edge_index(self.kegg_dir)
+            self._networks = [mna.determine_seed_set(mna.make_metabolic_network_from_kos(genome, index,
+                                                                                         only_giant=True))
+                              for genome in self.genomes]
+        return self._networks
+
+    @property
+    def kb(self):
+        """the web app, imported once the genome database it reads from is built"""
+        if self._kb is None:
+            build_database(self)
+            import micrometab_kb
+            micrometab_kb.app.secret_key = 'benchmark'
+            self._kb = micrometab_kb
+        return self._kb
+
+
+def build_database(ctx):
+    import populate_genome_db
+    db_loc = os.path.join(ctx.data_dir, DB_NAME)
+    for loc in (db_loc, db_loc + '-wal', db_loc + '-shm'):
+        if os.path.exists(loc):
+            os.remove(loc)
+    engine = populate_genome_db.get_engine(db_loc)
+    taxonomy = dict([line.rstrip('\n').split('\t') for line in open(os.path.join(ctx.data_dir,
+                                                                                 synthetic.TAXONOMY_NAME))])
+    _, genomes = populate_genome_db.generate_genome_local([(otu, taxonomy[otu], None) for otu in ctx.otus],
+                                                          ctx.kegg_dir)
+    populate_genome_db.write_genomes(engine, genomes)
+    # checkpoint the WAL so the app's read only connections see one file
+    engine.dispose()
+
+
+@benchmark('kegg_parse')
+def bench_kegg_parse(ctx):
+    parse_KEGG.KEGGParser(ctx.kegg_dir)
+    getters = [parse_KEGG.get_ko2rxns, parse_KEGG.get_reactions]
+    n_entries = sum([open(ctx.kegg_dir + loc).read().count('\n///') for loc in ('ko', 'reaction')])
+    return lambda: parse_KEGG.build_maps(getters), n_entries, 'entries'
+
+
+@benchmark('kegg_load_cached')
+def bench_kegg_load_cached(ctx):
+    parse_KEGG.KEGGParser(ctx.kegg_dir)
+    getters = [parse_KEGG.get_ko2rxns, parse_KEGG.get_reactions]
+    parse_KEGG.load_cached_maps(getters)
+    return lambda: parse_KEGG.load_cached_maps(getters), len(getters), 'maps'
+
+
+@benchmark('convert_precalc_to_biom')
+def bench_convert_precalc_to_biom(ctx):
+    def run():
+        with gzip.open(pu.get_precalc_fp(), 'rt') as f:
+            pu.convert_precalc_to_biom(f, ctx.sample)
+    return run, len(ctx.sample), 'otus'
+
+
+@benchmark('load_data_table')
+def bench_load_data_table(ctx):
+    pu.load_data_table(ctx.sample)
+    return lambda: pu.load_data_table(ctx.sample), len(ctx.sample), 'otus'
+
+
+@benchmark('make_metabolic_network')
+def bench_make_metabolic_network(ctx):
+    genomes = ctx.genomes
+    mna.get_kegg(ctx.kegg_dir).load_reactome_maps()
+
+    def run():
+        for genome in genomes:
+            mna.make_metabolic_network(mna.get_rxns_local(mna.get_reactome_local(genome)), only_giant=True)
+    return run, len(genomes), 'genomes'
+
+
+@benchmark('make_metabolic_network_from_kos')
+def bench_make_metabolic_network_from_kos(ctx):
+    genomes = ctx.genomes
+    index = mna.get_ko_edge_index(ctx.kegg_dir)
+
+    def run():
+        for genome in genomes:
+            mna.make_metabolic_network_from_kos(genome, index, only_giant=True)
+    return run, len(genomes), 'genomes'
+
+
+@benchmark('determine_seed_set')
+def bench_determine_seed_set(ctx):
+    networks = [network for network, _ in ctx.networks]
+
+    def run():
+        for network in networks:
+            mna.determine_seed_set(network)
+    return run, len(networks), 'networks'
+
+
+@benchmark('calculate_bss_mci')
+def bench_calculate_bss_mci(ctx):
+    networks = ctx.networks
+    pairs = [(networks[i], networks[j]) for i, j in [ctx.rnd.sample(range(len(networks)), 2) for _ in ctx.pairs]]
+
+    def run():
+        for (net1, seeds1), (net2, seeds2) in pairs:
+            mna.calculate_bss(net1, seeds1, net2, seeds2)
+            mna.calculate_mci(net1, seeds1, net2, seeds2)
+    return run, len(pairs), 'pairs'
+
+
+@benchmark('community_bss_mci')
+def bench_community_bss_mci(ctx):
+    nodes = [set(network.nodes()) for network, _ in ctx.networks]
+    seed_sets = [seed_set for _, seed_set in ctx.networks]
+    return (lambda: community_metrics.calculate_bss_mci_matrices(nodes, seed_sets), len(nodes) * (len(nodes) - 1),
+            'pairs')
+
+
+@benchmark('tree_load')
+def bench_tree_load(ctx):
+    return lambda: TreeDistance.read(pu.get_tree_loc()), len(ctx.otus), 'tips'
+
+
+@benchmark('get_tip2tip')
+def bench_get_tip2tip(ctx):
+    kb = ctx.kb
+    kb.get_tree_distance()
+
+    def run():
+        for otu1, otu2 in ctx.pairs:
+            kb.get_tip2tip(otu1, otu2)
+    return run, len(ctx.pairs), 'pairs'
+
+
+def post(client, url, data):
+    response = client.post(url, data=data)
+    if response.status_code != 200:
+        raise RuntimeError("%s returned %s" % (url, response.status_code))
+    # read the body so streamed responses are actually generated
+    return response.get_data()
+
+
+@benchmark('flask_single_cold')
+def bench_flask_single_cold(ctx):
+    kb = ctx.kb
+    client = kb.app.test_client()
+
+    def run():
+        for otu in ctx.sample:
+            kb.get_genome_cache().clear()
+            post(client, '/result/single_otu/', {'name': otu})
+    return run, len(ctx.sample), 'requests'
+
+
+@benchmark('flask_single_warm')
+def bench_flask_single_warm(ctx):
+    kb = ctx.kb
+    client = kb.app.test_client()
+    for otu in ctx.sample:
+        post(client, '/result/single_otu/', {'name': otu})
+
+    def run():
+        for otu in ctx.sample:
+            post(client, '/result/single_otu/', {'name': otu})
+    return run, len(ctx.sample), 'requests'
+
+
+@benchmark('flask_pair')
+def bench_flask_pair(ctx):
+    kb = ctx.kb
+    client = kb.app.test_client()
+    kb.get_tree_distance()
+
+    def run():
+        for otu1, otu2 in ctx.pairs:
+            post(client, '/result/pair_otu/', {'name1': otu1, 'name2': otu2})
+    return run, len(ctx.pairs), 'requests'
+
+
+@benchmark('flask_get')
+def bench_flask_get(ctx):
+    client = ctx.kb.app.test_client()
+    batches = [ctx.sample[i:i+10] for i in range(0, len(ctx.sample), 10)]
+
+    def run():
+        for batch in batches:
+            response = client.get('/get/%s' % ','.join(batch))
+            if response.status_code != 200:
+                raise RuntimeError("/get/ returned %s" % response.status_code)
+    return run, len(ctx.sample), 'genomes'
+
+
+@benchmark('flask_export')
+def bench_flask_export(ctx):
+    client = ctx.kb.app.test_client()
+
+    def run():
+        response = client.post('/export/', json={'otu_ids': ctx.otus})
+        if response.status_code != 200:
+            raise RuntimeError("/export/ returned %s" % response.status_code)
+        response.get_data()
+    return run, len(ctx.otus), 'genomes'
+
+
+def time_benchmark(run, repeat):
+    times = list()
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def peak_memory(run):
+    """peak MB allocated by python and numpy while run runs"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024. / 1024.
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(ctx, names, repeat=repeat):
+    results = dict()
+    for name, setup in BENCHMARKS:
+        if name not in names:
+            continue
+        run, items, unit = setup(ctx)
+        times = time_benchmark(run, repeat)
+        best = min(times)
+        results[name] = {'seconds': times, 'best': best, 'median': sorted(times)[len(times) // 2], 'items': items,
+                         'unit': unit, 'per_second': items / best if best > 0 else None,
+                         'peak_mb': peak_memory(run)}
+        print("%-34s %10.4fs %12.1f %s/s %9.1f MB peak" % (name, best, results[name]['per_second'] or 0, unit,
+                                                           results[name]['peak_mb']))
+    return results
+
+
+def compare(results, previous_loc):
+    with open(previous_loc) as f:
+        previous = json.load(f)['benchmarks']
+    print("\n%-34s %14s %14s %8s" % ('benchmark', 'per_second', 'previous', 'ratio'))
+    for name, result in results.items():
+        if name in previous and previous[name]['per_second'] and result['per_second']:
+            print("%-34s %14.1f %14.1f %7.2fx" % (name, result['per_second'], previous[name]['per_second'],
+                                                  result['per_second'] / previous[name]['per_second']))
+
+
+def main():
+    names = [name for name, _ in BENCHMARKS]
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--data_dir", help="where synthetic inputs and the genome database are written",
+                        default=DATA_DIR)
+    parser.add_argument("--output", help="JSON results file, a timestamped file in benchmarks/results if not given")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--only", help="benchmarks to run", nargs='+', choices=names, default=names)
+    parser.add_argument("--repeat", help="timed runs of each benchmark", type=int, default=repeat)
+    parser.add_argument("--otus", help="OTUs in the synthetic precalculated table and tree", type=int, default=500)
+    parser.add_argument("--kos", help="KOs in the synthetic KEGG snapshot", type=int, default=600)
+    parser.add_argument("--sample", help="OTUs used by per genome benchmarks", type=int, default=sample)
+    parser.add_argument("--pairs", help="OTU pairs used by pairwise benchmarks", type=int, default=pairs)
+    parser.add_argument("--seed", help="random seed for inputs and samples", type=int, default=0)
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    output = None if args.output is None else os.path.abspath(args.output)
+    previous = None if args.compare is None else os.path.abspath(args.compare)
+    params, otus = synthetic.generate(data_dir, n_otus=args.otus, n_kos=args.kos, n_rxns=2 * args.kos,
+                                      n_cos=int(1.3 * args.kos), seed=args.seed)
+    # the app, network filters and genome builder all read their inputs relative to the working directory
+    os.chdir(data_dir)
+    pu.DATA_DIR = data_dir
+    parse_KEGG.KEGGParser(os.path.join(data_dir, 'kegg') + os.sep, cache_dir=os.path.join(data_dir, 'pickles'))
+    pu.index_precalc_table(pu.get_precalc_fp())
+
+    ctx = Context(data_dir, otus, args.sample, args.pairs, args.seed)
+    started = datetime.now()
+    results = run_benchmarks(ctx, args.only, args.repeat)
+    report = {'started': started.isoformat(), 'commit': get_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'inputs': params,
+              'args': {'sample': args.sample, 'pairs': args.pairs, 'repeat': args.repeat},
+              # ru_maxrss is in KB on linux
+              'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+              'benchmarks': results}
+
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, started.strftime('%Y%m%d_%H%M%S') + '.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to %s" % output)
+    if previous is not None:
+        compare(results, previous)
+
+
+if __name__ == "__main__":
+    main()
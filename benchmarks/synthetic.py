@@ -0,0 +1,142 @@
+"""Deterministic synthetic inputs for the benchmarks: KEGG flat files, a PICRUSt style precalculated KO table, a
+greengenes style taxonomy and tree, and the cos_to_remove.txt the network filters read.  The same seed always
+writes the same files, so results from different runs and machines compare like for like.
+"""
+import gzip
+import json
+import os
+import random
+
+PRECALC_NAME = "ko_13_5_precalculated.tab.gz"
+TREE_NAME = os.path.join("gg_13_8_otus", "trees", "99_otus.tree")
+TAXONOMY_NAME = "99_otu_taxonomy.txt"
+COS_TO_REMOVE_NAME = "cos_to_remove.txt"
+PARAMS_NAME = "params.json"
+
+RANKS = ['k__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__']
+
+
+def write_kegg(kegg_dir, n_kos, n_rxns, n_cos, n_glycans, rnd):
+    """reaction, ko, compound and glycan files in the layout parse_KEGG reads"""
+    os.makedirs(kegg_dir, exist_ok=True)
+    cos = ['C%05d' % i for i in range(1, n_cos + 1)]
+    glycans = ['G%05d' % i for i in range(1, n_glycans + 1)]
+    kos = ['K%05d' % i for i in range(1, n_kos + 1)]
+    rxns = ['R%05d' % i for i in range(1, n_rxns + 1)]
+    pathways = ['%05d' % i for i in range(10, 1200, 10)]
+    # a few hub compounds like water and ATP show up in many reactions
+    hubs = cos[:10]
+
+    rxn_kos = {rxn: rnd.sample(kos, rnd.randint(0, 3)) for rxn in rxns}
+    ko_rxns = {ko: list() for ko in kos}
+    for rxn, rxn_ko in rxn_kos.items():
+        for ko in rxn_ko:
+            ko_rxns[ko].append(rxn)
+
+    with open(os.path.join(kegg_dir, 'reaction'), 'w') as f:
+        for rxn in rxns:
+            left = rnd.sample(cos + glycans, rnd.randint(1, 3)) + rnd.sample(hubs, rnd.randint(0, 1))
+            right = rnd.sample(cos, rnd.randint(1, 3)) + rnd.sample(hubs, rnd.randint(0, 1))
+            side = lambda part: ' + '.join([('%d ' % rnd.randint(2, 3) if rnd.random() < .1 else '') + co
+                                            for co in part])
+            f.write('ENTRY       %s                      Reaction\n' % rxn)
+            f.write('NAME        reaction %s\n' % rxn)
+            f.write('EQUATION    %s %s %s\n' % (side(left), rnd.choice(['<=>', '=>']), side(right)))
+            for i, pathway in enumerate(rnd.sample(pathways, rnd.randint(0, 3))):
+                f.write('%-12srn%s  Pathway %s\n' % ('PATHWAY' if i == 0 else '', pathway, pathway))
+            for i, ko in enumerate(rxn_kos[rxn]):
+                f.write('%-12s%s  enzyme [EC:1.1.1.1]\n' % ('ORTHOLOGY' if i == 0 else '', ko))
+            f.write('///\n')
+
+    with open(os.path.join(kegg_dir, 'ko'), 'w') as f:
+        for ko in kos:
+            f.write('ENTRY       %s                      KO\n' % ko)
+            f.write('NAME        gene%s\n' % ko[1:])
+            f.write('DEFINITION  enzyme %s [EC:1.1.1.%d]\n' % (ko, rnd.randint(1, 9)))
+            for i, pathway in enumerate(rnd.sample(pathways, rnd.randint(0, 3))):
+                f.write('%-12sko%s  Pathway %s\n' % ('PATHWAY' if i == 0 else '', pathway, pathway))
+            f.write('CLASS       Metabolism; Class %d; Sub [PATH:ko00010]\n' % rnd.randint(1, 5))
+            links = list()
+            if len(ko_rxns[ko]) > 0:
+                links.append('RN: ' + ' '.join(ko_rxns[ko]))
+            links.append('COG: COG%04d' % rnd.randint(1, 999))
+            f.write('DBLINKS     ' + '\n            '.join(links) + '\n')
+            f.write('GENES       ECO: b0001(thrL)\n///\n')
+
+    for loc, ids, kind in (('compound', cos, 'Compound'), ('glycan', glycans, 'Glycan')):
+        with open(os.path.join(kegg_dir, loc), 'w') as f:
+            for co in ids:
+                f.write('ENTRY       %s                      %s\n' % (co, kind))
+                f.write('NAME        %s %s;\n            alt name\n' % (kind.lower(), co))
+                if kind == 'Compound':
+                    f.write('FORMULA     C%dH%dO%d\n' % (rnd.randint(1, 20), rnd.randint(1, 40), rnd.randint(0, 9)))
+                    f.write('EXACT_MASS  %.4f\n' % (rnd.random() * 500))
+                co_rxns = rnd.sample(rxns, rnd.randint(0, 6))
+                if len(co_rxns) > 0:
+                    f.write('REACTION    %s\n' % ' '.join(co_rxns))
+                for i, pathway in enumerate(rnd.sample(pathways, rnd.randint(0, 3))):
+                    f.write('%-12smap%s  Pathway name %s\n' % ('PATHWAY' if i == 0 else '', pathway, pathway))
+                f.write('///\n')
+    return kos, hubs
+
+
+def write_precalc(fp, otus, kos, rnd):
+    """gzipped table of KO counts per OTU with the NSTI and KEGG_Pathways metadata PICRUSt ships"""
+    with gzip.open(fp, 'wt') as f:
+        f.write('\t'.join(['#OTU_IDs'] + kos + ['metadata_NSTI']) + '\n')
+        f.write('\t'.join(['metadata_KEGG_Pathways'] + ['Metabolism;Path %d|Other;Thing' % rnd.randint(1, 9)
+                                                        for _ in kos]) + '\n')
+        for otu in otus:
+            # each genome carries about a third of the KOs
+            counts = [rnd.choice(['0', '0', '0', '0', '1', '1', '2']) for _ in kos]
+            f.write('\t'.join([otu] + counts + ['%.3f' % rnd.random()]) + '\n')
+
+
+def write_taxonomy(fp, otus, rnd):
+    with open(fp, 'w') as f:
+        for otu in otus:
+            depth = rnd.randint(1, 7)
+            taxa = [rank + ('taxon%d' % rnd.randint(1, 20) if i < depth else '') for i, rank in enumerate(RANKS)]
+            f.write('%s\t%s\n' % (otu, '; '.join(taxa)))
+
+
+def write_tree(fp, otus, rnd):
+    """random rooted binary tree in newick with the OTUs as tips"""
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    nodes = ['%s:%.4f' % (otu, rnd.random() / 10) for otu in otus]
+    rnd.shuffle(nodes)
+    while len(nodes) > 1:
+        i = rnd.randrange(len(nodes) - 1)
+        nodes[i:i+2] = ['(%s,%s):%.4f' % (nodes[i], nodes[i+1], rnd.random() / 10)]
+    with open(fp, 'w') as f:
+        f.write(nodes[0].rsplit(':', 1)[0] + ';\n')
+
+
+def generate(data_dir, n_otus=500, n_kos=600, n_rxns=1200, n_cos=800, n_glycans=50, seed=0):
+    """write every input into data_dir, skipping it if it already holds the inputs for these parameters
+
+    Returns the parameters written, with the OTU ids
+    """
+    params = {'n_otus': n_otus, 'n_kos': n_kos, 'n_rxns': n_rxns, 'n_cos': n_cos, 'n_glycans': n_glycans,
+              'seed': seed}
+    params_fp = os.path.join(data_dir, PARAMS_NAME)
+    otus = [str(i) for i in range(1, n_otus + 1)]
+    try:
+        with open(params_fp) as f:
+            if json.load(f) == params:
+                return params, otus
+    except (IOError, ValueError):
+        pass
+
+    rnd = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    kos, hubs = write_kegg(os.path.join(data_dir, 'kegg'), n_kos, n_rxns, n_cos, n_glycans, rnd)
+    write_precalc(os.path.join(data_dir, PRECALC_NAME), otus, kos, rnd)
+    write_taxonomy(os.path.join(data_dir, TAXONOMY_NAME), otus, rnd)
+    write_tree(os.path.join(data_dir, TREE_NAME), otus, rnd)
+    with open(os.path.join(data_dir, COS_TO_REMOVE_NAME), 'w') as f:
+        f.write('\n'.join(hubs) + '\n')
+    # written last so an interrupted generation is redone
+    with open(params_fp, 'w') as f:
+        json.dump(params, f)
+    return params, otus
@@ -0,0 +1,110 @@
+"""Pairwise competition (MCI), complementarity (BSS) and tip to tip distance for every pair of OTUs in a community,
+computed in one pass from the seed sets and networks stored in the genome database."""
+import argparse
+import json
+import math
+import sys
+
+from biom import load_table
+from sqlalchemy import create_engine
+from sqlalchemy.orm import joinedload, sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+
+from database_setup import Genome
+from micrometab_analysis import picrust_util as pu
+from micrometab_analysis.community_metrics import calculate_bss_mci_matrices
+from micrometab_analysis.tree_distance import TreeDistance
+
+DB_LOC = "gg_genomes.db"
+block_size = 500
+procs = 1
+
+
+def get_otu_ids_from_biom(biom_loc):
+    return [str(i) for i in load_table(biom_loc).ids(axis='observation')]
+
+
+def get_genomes(session, otu_ids, skip_missing=False):
+    """genomes for otu_ids in the same order, raising NoResultFound listing any OTUs not in the database unless
+    skip_missing, when they are left out"""
+    genomes = dict()
+    for i in range(0, len(otu_ids), 995):
+        chunk = otu_ids[i:i+995]
+        query = session.query(Genome).options(joinedload(Genome.data)).filter(Genome.name.in_(chunk))
+        genomes.update({str(genome.name): genome for genome in query})
+    missing = [i for i in otu_ids if str(i) not in genomes]
+    if skip_missing:
+        return [genomes[str(i)] for i in otu_ids if str(i) in genomes]
+    if len(missing) > 0:
+        raise NoResultFound("Not all OTUs found. %s are missing" % ', '.join(missing))
+    return [genomes[str(i)] for i in otu_ids]
+
+
+def analyze_community(genomes, tree_distance, block_size=block_size, nprocs=procs):
+    """bss, mci and tip to tip matrices for a list of genomes, row i relative to column j"""
+    otus = [str(genome.name) for genome in genomes]
+    nodes = [genome.metab_graph.node_set() for genome in genomes]
+    seed_sets = [genome.seed_sets for genome in genomes]
+    bss, mci = calculate_bss_mci_matrices(nodes, seed_sets, block_size, nprocs)
+    tip2tip = tree_distance.distance_matrix(otus)
+    return {'otus': otus, 'bss': bss, 'mci': mci, 'tip2tip': tip2tip}
+
+
+def _matrix_to_list(matrix, undefined=None):
+    return [[value if math.isfinite(value) else undefined for value in row] for row in matrix.tolist()]
+
+
+def community_to_json(community):
+    """community as plain lists, bss and mci of an OTU without seed groups are undefined and null, as json has no
+    NaN"""
+    return {'otus': community['otus'], 'bss': _matrix_to_list(community['bss']),
+            'mci': _matrix_to_list(community['mci']), 'tip2tip': _matrix_to_list(community['tip2tip'])}
+
+
+def iter_community_tsv(community):
+    """tab separated lines, one per ordered pair of OTUs, with bss and mci of otu1 relative to otu2, NA when otu1 has
+    no seed groups, an empty network, so neither is defined"""
+    yield '\t'.join(['otu1', 'otu2', 'tip2tip', 'bss', 'mci']) + '\n'
+    otus = community['otus']
+    tip2tip, bss, mci = [_matrix_to_list(community[i], 'NA') for i in ('tip2tip', 'bss', 'mci')]
+    for i, otu1 in enumerate(otus):
+        for j, otu2 in enumerate(otus):
+            if i != j:
+                yield '%s\t%s\t%s\t%s\t%s\n' % (otu1, otu2, tip2tip[i][j], bss[i][j], mci[i][j])
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--otu_ids", help="comma separated list of OTU ids")
+    input_group.add_argument("--biom_loc", help="BIOM OTU table, all observations are analyzed")
+    parser.add_argument("--db_loc", help="location of genome database", default=DB_LOC)
+    parser.add_argument("--tree_loc", help="location of greengenes tree", default=pu.get_tree_loc())
+    parser.add_argument("--output", help="output file, stdout if not given")
+    parser.add_argument("--format", help="output format", choices=["json", "tsv"], default="tsv")
+    parser.add_argument("--nprocs", help="number of processors", type=int, default=procs)
+    parser.add_argument("--block_size", help="OTUs compared against the community at a time", type=int,
+                        default=block_size)
+    args = parser.parse_args()
+
+    if args.otu_ids is not None:
+        otu_ids = [i.strip() for i in args.otu_ids.split(',') if len(i.strip()) > 0]
+    else:
+        otu_ids = get_otu_ids_from_biom(args.biom_loc)
+
+    engine = create_engine('sqlite:///%s' % args.db_loc)
+    session = sessionmaker(bind=engine)()
+    genomes = get_genomes(session, otu_ids)
+    community = analyze_community(genomes, TreeDistance.read(args.tree_loc), args.block_size, args.nprocs)
+
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    if args.format == "json":
+        json.dump(community_to_json(community), out)
+    else:
+        out.writelines(iter_community_tsv(community))
+    if args.output is not None:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
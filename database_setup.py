@@ -1,5 +1,11 @@
-from sqlalchemy import Column, Integer, String, Float, create_engine
+import json
+
+from sqlalchemy import Column, ForeignKey, Integer, String, Float, LargeBinary, create_engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+
+from micrometab_analysis.compact_graph import CompactGraph
+from micrometab_analysis.ko_sets import kos_to_str, unpack_kos
 
 Base = declarative_base()
 
@@ -7,13 +13,40 @@ Base = declarative_base()
 class Genome(Base):
     __tablename__ = 'genomes'
 
-    name = Column(Integer, nullable=False)
+    name = Column(Integer, nullable=False, unique=True, index=True)
     id = Column(Integer, primary_key=True)
 
     taxonomy = Column(String(1000))
     nsti = Column(Float)
-    metab_net = Column(String(100000))
-    genome = Column(String(1000))
+    seeds = Column(String(100000))
+    # hash of the build inputs this genome was made from, see populate_genome_db.get_genome_fingerprint
+    fingerprint = Column(String(40))
+    # network and KO list, only read when a genome's network is needed
+    data = relationship('GenomeData', uselist=False, lazy='select')
+
+    @property
+    def metab_net(self):
+        return self.data.metab_net
+
+    @property
+    def genome(self):
+        """comma joined KO ids"""
+        return kos_to_str(self.data.genome)
+
+    @property
+    def kos(self):
+        """sorted array of KO codes"""
+        return unpack_kos(self.data.genome)
+
+    @property
+    def seed_sets(self):
+        """seed groups computed at build time, keyed by seed group number like mna.determine_seed_set"""
+        return {i: seeds for i, seeds in enumerate(json.loads(self.seeds))}
+
+    @property
+    def metab_graph(self):
+        """metabolic network stored in compact_graph format, only expanded to networkx/cytoscape when asked"""
+        return CompactGraph.from_bytes(self.metab_net)
 
     @property
     def serialize(self):
@@ -21,10 +54,21 @@ class Genome(Base):
             'name': self.name,
             'taxonomy': self.taxonomy,
             'nsti': self.nsti,
-            'metab_net': self.metab_net,
+            'metab_net': json.dumps(self.metab_graph.to_cytoscape()),
             'genome': self.genome
         }
 
 
+class GenomeData(Base):
+    """the large per genome payloads, in their own table so genomes rows stay small and lookups by name only read
+    the metadata"""
+    __tablename__ = 'genome_data'
+
+    name = Column(Integer, ForeignKey('genomes.name'), primary_key=True)
+    metab_net = Column(LargeBinary)
+    # KOs packed as a bitset, see ko_sets
+    genome = Column(LargeBinary)
+
+
 engine = create_engine('sqlite:///gg_genomes.db')
 Base.metadata.create_all(engine)
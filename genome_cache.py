@@ -0,0 +1,125 @@
+"""In process LRU cache of genomes ready for the web app: parsed network, seed sets, node set and the cytoscape
+elements already serialized, bounded by a number of genomes and an approximate memory budget and emptied whenever
+the database file changes on disk."""
+import json
+import os
+import sys
+from collections import OrderedDict
+from threading import Lock
+
+MAX_GENOMES = 5000
+MAX_MB = 512
+
+
+class ProcessedGenome:
+    """everything the result pages need from a Genome row, computed once"""
+    def __init__(self, genome, taxa_str):
+        self.name = genome.name
+        self.taxonomy = genome.taxonomy
+        self.nsti = genome.nsti
+        self.fingerprint = genome.fingerprint
+        self.taxa_str = taxa_str
+        self.metab_graph = genome.metab_graph
+        self.seed_sets = genome.seed_sets
+        self.seeds = set([j for i in self.seed_sets.values() for j in i])
+        self.nodes = self.metab_graph.node_set()
+        self.eles = json.dumps(self.metab_graph.to_cytoscape_elements())
+        self.size = self.estimate_size()
+
+    def estimate_size(self):
+        """rough bytes held, dominated by the serialized elements and the python strings in the node set"""
+        graph = self.metab_graph
+        arrays = graph.nodes.nbytes + graph.indptr.nbytes + graph.indices.nbytes + graph.seed_groups.nbytes
+        node_strs = sys.getsizeof(self.nodes) + sum([sys.getsizeof(i) for i in self.nodes])
+        # node_ids list on the graph shares its strings with the node set
+        return sys.getsizeof(self.eles) + arrays + 2 * node_strs + sys.getsizeof(self.seeds) + len(self.taxonomy)
+
+
+def get_db_signature(db_loc):
+    """modification time and size of the database and its write ahead log, None if it doesn't exist"""
+    signature = list()
+    for loc in (db_loc, db_loc + '-wal'):
+        try:
+            stat = os.stat(loc)
+        except OSError:
+            signature.append(None)
+        else:
+            signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class GenomeCache:
+    """thread safe LRU of ProcessedGenomes keyed on OTU id, on_change is called after the database changes"""
+    def __init__(self, db_loc, max_genomes=MAX_GENOMES, max_mb=MAX_MB, on_change=None):
+        self.db_loc = db_loc
+        self.on_change = on_change
+        self.max_genomes = max_genomes
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.genomes = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.signature = get_db_signature(db_loc)
+        self.lock = Lock()
+
+    def check_db(self):
+        """drop everything if the database has changed since it was last checked"""
+        signature = get_db_signature(self.db_loc)
+        with self.lock:
+            if signature == self.signature:
+                return
+            self.signature = signature
+            if len(self.genomes) > 0:
+                self.invalidations += 1
+            self.genomes.clear()
+            self.size = 0
+        if self.on_change is not None:
+            self.on_change()
+
+    def get(self, name, loader):
+        """cached genome for name, calling loader(name) to build it on a miss
+
+        loader errors, NoResultFound for a missing OTU included, are raised to the caller and nothing is cached
+        """
+        name = str(name)
+        self.check_db()
+        with self.lock:
+            genome = self.genomes.get(name)
+            if genome is not None:
+                self.genomes.move_to_end(name)
+                self.hits += 1
+                return genome
+            self.misses += 1
+        # build outside the lock, a concurrent miss on the same genome only costs a duplicate build
+        genome = loader(name)
+        self.put(name, genome)
+        return genome
+
+    def put(self, name, genome):
+        with self.lock:
+            if name in self.genomes:
+                self.size -= self.genomes.pop(name).size
+            if genome.size > self.max_bytes or self.max_genomes < 1:
+                return
+            self.genomes[name] = genome
+            self.size += genome.size
+            while len(self.genomes) > self.max_genomes or self.size > self.max_bytes:
+                _, evicted = self.genomes.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.genomes.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'genomes': len(self.genomes), 'max_genomes': self.max_genomes,
+                    'size_mb': round(self.size / 1024. / 1024., 3), 'max_mb': round(self.max_bytes / 1024. / 1024., 3),
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / float(lookups), 4) if lookups > 0 else None,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
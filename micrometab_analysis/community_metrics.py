@@ -0,0 +1,172 @@
+"""community_metrics.py
+All pairs biosynthetic support score (BSS) and metabolic competition index (MCI) for a community of genomes.
+Every genome's node set, seed set union and seed groups are encoded as sparse boolean matrices over one
+compound index shared by the community, so the per pair set intersections of mna.calculate_bss and
+mna.calculate_mci become two sparse matrix products:
+
+    group_hits_nodes[g, j] = seed group g shares a compound with the network of genome j
+    group_hits_seeds[g, j] = seed group g shares a compound with the seeds of genome j
+
+bss[i, j] is the fraction of genome i's seed groups hitting genome j's network and mci[i, j] the fraction hitting
+genome j's network but none of its seeds, matching seed1net2_bss and seed1net2_mci with genome i as otu1.
+"""
+
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+
+
+class CommunityEncoding:
+    """sparse boolean encodings of a community's networks and seed groups over a shared compound index"""
+    def __init__(self, nodes, seed_sets):
+        compound_index = dict()
+        node_rows, node_cols = list(), list()
+        seed_rows, seed_cols = list(), list()
+        group_rows, group_cols = list(), list()
+        group_owners = list()
+        for i, (genome_nodes, genome_seed_sets) in enumerate(zip(nodes, seed_sets)):
+            for co in genome_nodes:
+                node_rows.append(i)
+                node_cols.append(compound_index.setdefault(co, len(compound_index)))
+            genome_seeds = set()
+            for seeds in genome_seed_sets.values():
+                for co in seeds:
+                    group_rows.append(len(group_owners))
+                    group_cols.append(compound_index.setdefault(co, len(compound_index)))
+                    genome_seeds.add(co)
+                group_owners.append(i)
+            for co in genome_seeds:
+                seed_rows.append(i)
+                seed_cols.append(compound_index[co])
+
+        n_genomes = len(nodes)
+        n_compounds = len(compound_index)
+        self.compound_index = compound_index
+        self.nodes = _bool_matrix(node_rows, node_cols, (n_genomes, n_compounds))
+        self.seeds = _bool_matrix(seed_rows, seed_cols, (n_genomes, n_compounds))
+        self.groups = _bool_matrix(group_rows, group_cols, (len(group_owners), n_compounds))
+        self.group_owners = np.array(group_owners, dtype=np.int64)
+        self.group_counts = np.bincount(self.group_owners, minlength=n_genomes)
+        # seed groups of genome i are rows group_starts[i]:group_starts[i+1] of groups
+        self.group_starts = np.zeros(n_genomes + 1, dtype=np.int64)
+        self.group_starts[1:] = np.cumsum(self.group_counts)
+
+    def __len__(self):
+        return self.nodes.shape[0]
+
+    @staticmethod
+    def _counts(groups, owners, n_owners, nodes, seeds):
+        # hits stay sparse, a seed group touches few genomes, only the owner by genome counts are made dense
+        hits_nodes = ((groups @ nodes.T) > 0).astype(np.float64)
+        hits_seeds = ((groups @ seeds.T) > 0).astype(np.float64)
+        owner_matrix = _bool_matrix(owners, np.arange(len(owners)), (n_owners, len(owners)))
+        bss_counts = (owner_matrix @ hits_nodes).toarray()
+        mci_counts = (owner_matrix @ (hits_nodes - hits_nodes.multiply(hits_seeds))).toarray()
+        return bss_counts, mci_counts
+
+    def block_counts(self, start, stop):
+        """counts of seed groups of genomes start:stop that hit every genome's network and network but not seeds"""
+        groups = self.groups[self.group_starts[start]:self.group_starts[stop]]
+        owners = self.group_owners[self.group_starts[start]:self.group_starts[stop]] - start
+        return self._counts(groups, owners, stop - start, self.nodes, self.seeds)
+
+    def block_metrics(self, start, stop):
+        """bss and mci rows for genomes start:stop against every genome in the community"""
+        bss_counts, mci_counts = self.block_counts(start, stop)
+        group_counts = self.group_counts[start:stop, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return bss_counts / group_counts, mci_counts / group_counts
+
+    def subset_metrics(self, members):
+        """bss and mci among only the genomes at positions members, rows and columns in the order of members, for
+        the sub-communities of a large community without N by N arrays"""
+        members = np.asarray(members, dtype=np.int64)
+        group_counts = self.group_counts[members]
+        group_rows = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                    [np.arange(self.group_starts[i], self.group_starts[i + 1]) for i in members])
+        owners = np.repeat(np.arange(len(members)), group_counts)
+        bss_counts, mci_counts = self._counts(self.groups[group_rows], owners, len(members), self.nodes[members],
+                                              self.seeds[members])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return bss_counts / group_counts[:, np.newaxis], mci_counts / group_counts[:, np.newaxis]
+
+
+def _bool_matrix(rows, cols, shape):
+    data = np.ones(len(rows), dtype=np.float64)
+    matrix = sparse.csr_matrix((data, (rows, cols)), shape=shape)
+    matrix.data[:] = 1.  # duplicate entries are summed on construction
+    return matrix
+
+
+def get_blocks(n, block_size):
+    return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+
+encoding = None
+
+
+def _init_worker(community_encoding):
+    global encoding
+    encoding = community_encoding
+
+
+def _worker_block_metrics(block):
+    return block, encoding.block_metrics(*block)
+
+
+def calculate_bss_mci_matrices(nodes, seed_sets, block_size=500, nprocs=1):
+    """Calculate all pairs bss and mci for a community
+
+    Parameters
+    ----------
+    nodes: list of node sets, one per genome
+    seed_sets: list of seed set dicts as returned by mna.determine_seed_set, one per genome
+    block_size: number of genomes whose seed groups are compared against the community at a time
+    nprocs: number of processes to split blocks across
+
+    Returns
+    -------
+    bss, mci: N by N numpy arrays, bss[i, j] is the bss of genome i relative to genome j
+    """
+    community_encoding = CommunityEncoding(nodes, seed_sets)
+    n = len(community_encoding)
+    bss = np.zeros((n, n))
+    mci = np.zeros((n, n))
+    for (start, stop), (bss_block, mci_block) in iter_block_metrics(community_encoding, block_size, nprocs):
+        bss[start:stop] = bss_block
+        mci[start:stop] = mci_block
+    return bss, mci
+
+
+def iter_block_metrics(community_encoding, block_size=500, nprocs=1):
+    """yield ((start, stop), (bss rows, mci rows)) for blocks of genomes, in order of completion"""
+    blocks = get_blocks(len(community_encoding), block_size)
+    if nprocs == 1:
+        for block in blocks:
+            yield block, community_encoding.block_metrics(*block)
+    else:
+        pool = multiprocessing.Pool(nprocs, initializer=_init_worker, initargs=(community_encoding,))
+        try:
+            for result in pool.imap_unordered(_worker_block_metrics, blocks):
+                yield result
+        except BaseException:
+            # the consumer stopped early or failed, including closing this generator, so the blocks still queued
+            # are dropped rather than waited for
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+
+def iter_pair_metrics(names, nodes, seed_sets, block_size=500, nprocs=1):
+    """stream (name1, name2, bss, mci) for every ordered pair of distinct genomes without holding N by N arrays"""
+    community_encoding = CommunityEncoding(nodes, seed_sets)
+    for (start, stop), (bss_block, mci_block) in iter_block_metrics(community_encoding, block_size, nprocs):
+        for row in range(stop - start):
+            i = start + row
+            for j in range(len(names)):
+                if i != j:
+                    yield names[i], names[j], bss_block[row, j], mci_block[row, j]
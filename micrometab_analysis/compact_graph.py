@@ -0,0 +1,158 @@
+"""compact_graph.py
+Compact binary storage for metabolic networks.  Compound ids are interned as integers with kegg_ids (C00001 -> 1,
+G00001 -> 100001), nodes are kept sorted by that integer and edges are stored in CSR form (indptr/indices
+over node positions) along with the seed group of every node.  The arrays are read straight out of the
+stored bytes with np.frombuffer and networkx graphs or cytoscape elements are only built when asked for.
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+from micrometab_analysis.kegg_ids import decode_compounds, encode_compounds
+from micrometab_analysis.seed_detection import NOT_SEED, find_seed_groups, seed_sets_from_groups
+
+MAGIC = b'MMG1'
+HEADER = struct.Struct('<4sII')
+
+
+class CompactGraph:
+    """directed metabolic network stored as interned node ids and CSR edge arrays"""
+    def __init__(self, nodes, indptr, indices, seed_groups):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+        self.seed_groups = seed_groups
+        self._node_ids = None
+
+    @classmethod
+    def from_edges(cls, nodes, sources, targets, seed_groups=None):
+        """nodes is a list of compound ids, sources and targets are positions in nodes"""
+        return cls.from_code_edges(encode_compounds(nodes), sources, targets, seed_groups)
+
+    @classmethod
+    def from_code_edges(cls, codes, sources, targets, seed_groups=None):
+        """codes is an array of compound codes, sources and targets are positions in codes"""
+        codes = np.asarray(codes).astype('<u4')
+        order = np.argsort(codes, kind='stable')
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        sources = position[np.asarray(sources, dtype=np.int64)]
+        targets = position[np.asarray(targets, dtype=np.int64)]
+        edge_order = np.lexsort((targets, sources))
+        indptr = np.zeros(len(codes) + 1, dtype='<u4')
+        indptr[1:] = np.cumsum(np.bincount(sources, minlength=len(codes)))
+        if seed_groups is None:
+            seed_groups = np.full(len(codes), NOT_SEED, dtype='<i4')
+        else:
+            seed_groups = np.asarray(seed_groups, dtype='<i4')[order]
+        return cls(codes[order], indptr, targets[edge_order].astype('<u4'), seed_groups)
+
+    @classmethod
+    def from_networkx(cls, metab_net):
+        """build from a networkx graph, keeping SeedGroup node attributes set by mna.determine_seed_set"""
+        nodes = list()
+        seed_groups = list()
+        for node, data in metab_net.nodes(data=True):
+            nodes.append(node)
+            seed_groups.append(data.get('SeedGroup', NOT_SEED) if data.get('Seed', 0) == 1 else NOT_SEED)
+        node_index = {node: i for i, node in enumerate(nodes)}
+        edges = [(node_index[i], node_index[j]) for i, j in metab_net.edges()]
+        return cls.from_edges(nodes, [i for i, _ in edges], [j for _, j in edges], seed_groups)
+
+    @classmethod
+    def from_cytoscape(cls, metab_net_json):
+        """build from the cytoscape json previously stored in Genome.metab_net"""
+        nodes = list()
+        seed_groups = list()
+        for node in metab_net_json['elements']['nodes']:
+            nodes.append(node['data']['id'])
+            if node['data'].get('Seed', 0) == 1:
+                seed_groups.append(node['data']['SeedGroup'])
+            else:
+                seed_groups.append(NOT_SEED)
+        node_index = {node: i for i, node in enumerate(nodes)}
+        edges = [(node_index[edge['data']['source']], node_index[edge['data']['target']])
+                 for edge in metab_net_json['elements']['edges']]
+        return cls.from_edges(nodes, [i for i, _ in edges], [j for _, j in edges], seed_groups)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = zlib.decompress(data)
+        magic, n_nodes, n_edges = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a compact metabolic network.")
+        offset = HEADER.size
+        nodes = np.frombuffer(data, dtype='<u4', count=n_nodes, offset=offset)
+        offset += nodes.nbytes
+        indptr = np.frombuffer(data, dtype='<u4', count=n_nodes + 1, offset=offset)
+        offset += indptr.nbytes
+        indices = np.frombuffer(data, dtype='<u4', count=n_edges, offset=offset)
+        offset += indices.nbytes
+        seed_groups = np.frombuffer(data, dtype='<i4', count=n_nodes, offset=offset)
+        return cls(nodes, indptr, indices, seed_groups)
+
+    def to_bytes(self):
+        header = HEADER.pack(MAGIC, len(self.nodes), len(self.indices))
+        arrays = [self.nodes.astype('<u4'), self.indptr.astype('<u4'), self.indices.astype('<u4'),
+                  self.seed_groups.astype('<i4')]
+        return zlib.compress(header + b''.join([array.tobytes() for array in arrays]))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node_ids(self):
+        if self._node_ids is None:
+            self._node_ids = decode_compounds(self.nodes)
+        return self._node_ids
+
+    def node_set(self):
+        return set(self.node_ids())
+
+    def edges(self):
+        """edges as arrays of source and target node positions"""
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr.astype(np.int64)))
+        return sources, self.indices.astype(np.int64)
+
+    def csr(self):
+        return len(self.nodes), self.indptr, self.indices
+
+    def find_seeds(self):
+        """set seed_groups from the network's source strongly connected components, see seed_detection"""
+        self.seed_groups = find_seed_groups(*self.csr())
+        return self
+
+    def seed_sets(self):
+        """seed groups in the same form as mna.determine_seed_set"""
+        return seed_sets_from_groups(self.seed_groups, self.node_ids())
+
+    def to_networkx(self):
+        import networkx as nx
+        metab_net = nx.DiGraph()
+        for node, seed_group in zip(self.node_ids(), self.seed_groups.tolist()):
+            if seed_group == NOT_SEED:
+                metab_net.add_node(node, Seed=0)
+            else:
+                metab_net.add_node(node, Seed=1, SeedGroup=seed_group)
+        node_ids = self.node_ids()
+        sources, targets = self.edges()
+        metab_net.add_edges_from([(node_ids[i], node_ids[j]) for i, j in zip(sources.tolist(), targets.tolist())])
+        return metab_net
+
+    def to_cytoscape_elements(self):
+        """cytoscape.js elements matching what py2cytoscape.util.from_networkx made for a seeded network"""
+        nodes = list()
+        for node, seed_group in zip(self.node_ids(), self.seed_groups.tolist()):
+            if seed_group == NOT_SEED:
+                nodes.append({'data': {'id': node, 'name': node, 'Seed': 0}})
+            else:
+                nodes.append({'data': {'id': node, 'name': node, 'Seed': 1, 'SeedGroup': seed_group}})
+        node_ids = self.node_ids()
+        sources, targets = self.edges()
+        edges = [{'data': {'source': node_ids[i], 'target': node_ids[j]}}
+                 for i, j in zip(sources.tolist(), targets.tolist())]
+        return {'nodes': nodes, 'edges': edges}
+
+    def to_cytoscape(self):
+        return {'data': {}, 'elements': self.to_cytoscape_elements()}
@@ -0,0 +1,105 @@
+"""kegg_ids.py
+Interning of KEGG identifiers as integers.  Every id is a family letter and a 5 digit number, so the number is
+used as the code within its family: K00001 -> 1 and R00001 -> 1.  Compounds and glycans share one code space
+since both are network nodes, glycans being offset by GLYCAN_OFFSET (C00001 -> 1, G00001 -> 100001).  Codes
+are stable, so arrays of them can be stored on disk, and sort in the same order as the ids.
+
+Single ids are encoded and decoded with the encode_*/decode_* functions and lists or arrays of them with the
+vectorized encode_*s/decode_*s functions, which return uint32 arrays and lists of str.
+"""
+
+import numpy as np
+
+GLYCAN_OFFSET = 100000
+CODE_DTYPE = np.uint32
+
+
+def _check_families(ids, families, name):
+    letters = ids.astype('U1')
+    bad = ~np.isin(letters, families)
+    if bad.any():
+        raise ValueError("%s is not a KEGG %s id" % (ids[np.flatnonzero(bad)[0]], name))
+
+
+def _numbers(ids):
+    ids = np.asarray(ids, dtype='U')
+    if len(ids) == 0:
+        return ids, np.zeros(0, dtype=CODE_DTYPE)
+    return ids, np.char.lstrip(ids, 'CGKR').astype(CODE_DTYPE)
+
+
+def _format(letter, numbers):
+    numbers = np.asarray(numbers)
+    if numbers.size == 0:
+        return np.zeros(numbers.shape, dtype='U6')
+    return np.char.add(letter, np.char.zfill(numbers.astype('U5'), 5))
+
+
+def encode_compound(co):
+    if co[0] == 'C':
+        return int(co[1:])
+    elif co[0] == 'G':
+        return int(co[1:]) + GLYCAN_OFFSET
+    else:
+        raise ValueError("%s is not a KEGG compound or glycan id" % co)
+
+
+def decode_compound(i):
+    if i < GLYCAN_OFFSET:
+        return "C%05d" % i
+    else:
+        return "G%05d" % (i - GLYCAN_OFFSET)
+
+
+def encode_compounds(cos):
+    cos, codes = _numbers(cos)
+    _check_families(cos, ['C', 'G'], 'compound or glycan')
+    codes[np.char.startswith(cos, 'G')] += GLYCAN_OFFSET
+    return codes
+
+
+def decode_compounds(codes):
+    codes = np.asarray(codes, dtype=np.int64)
+    glycans = codes >= GLYCAN_OFFSET
+    ids = np.where(glycans, _format('G', codes - GLYCAN_OFFSET), _format('C', codes))
+    return ids.tolist()
+
+
+def encode_ko(ko):
+    if ko[0] != 'K':
+        raise ValueError("%s is not a KEGG KO id" % ko)
+    return int(ko[1:])
+
+
+def decode_ko(i):
+    return "K%05d" % i
+
+
+def encode_kos(kos):
+    kos, codes = _numbers(kos)
+    _check_families(kos, ['K'], 'KO')
+    return codes
+
+
+def decode_kos(codes):
+    return _format('K', codes).tolist()
+
+
+def encode_rxn(rxn):
+    if rxn[0] != 'R':
+        raise ValueError("%s is not a KEGG reaction id" % rxn)
+    return int(rxn[1:])
+
+
+def decode_rxn(i):
+    return "R%05d" % i
+
+
+def encode_rxns(rxns):
+    rxns, codes = _numbers(rxns)
+    _check_families(rxns, ['R'], 'reaction')
+    return codes
+
+
+def decode_rxns(codes):
+    return _format('R', codes).tolist()
@@ -0,0 +1,190 @@
+"""kegg_rest.py
+Client for the KEGG REST API used when genomes are built from remote data instead of local KEGG files.  Requests
+are made with asyncio over one pooled aiohttp session, at most `concurrency` at a time, asking for up to 10 entries
+per `get` call as the API allows.  Every entry fetched, and every id KEGG doesn't know, is kept in a SQLite file so
+later runs and other processes never ask for it again.  base_url can point at a local stub server for testing.
+
+aiohttp is only imported when something actually has to be fetched.
+"""
+
+import asyncio
+import sqlite3
+import time
+import warnings
+
+from micrometab_analysis.parse_KEGG import get_entry_id, iter_records, parse_equation
+
+BASE_URL = "http://rest.kegg.jp"
+CACHE_LOC = "kegg_rest_cache.sqlite"
+BATCH_SIZE = 10  # most entries KEGG returns from one get call
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+NOT_FOUND = ''
+
+
+def import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("aiohttp is needed to fetch data from the KEGG REST API, install it with "
+                          "pip install aiohttp")
+    return aiohttp
+
+
+def strip_prefix(kegg_id):
+    """K00001 for ko:K00001, KEGG gives entries without the database prefix"""
+    return kegg_id.split(':', 1)[-1]
+
+
+def split_entries(text):
+    """text of each entry in a KEGG flat file response keyed by entry id"""
+    entries = dict()
+    lines = list()
+    for line in text.splitlines(True):
+        lines.append(line)
+        if line.startswith('///'):
+            entry = ''.join(lines)
+            for record in iter_records(lines):
+                entries[get_entry_id(record)] = entry
+            lines = list()
+    return entries
+
+
+def parse_gene_rxns(gene, entry):
+    """reactions in the DBLINKS RN: line of a KO or gene entry"""
+    rxn_line = [i for i in entry.split('\n') if "RN:" in i.strip().split()]
+    if len(rxn_line) == 1:
+        return rxn_line[0][12:].split()[1:]
+    elif len(rxn_line) > 1:
+        warnings.warn("More than one reaction DBLINKS RN for %s" % gene)
+    return list()
+
+
+def parse_rxn_equation(entry):
+    equ_line = [i for i in entry.split('\n') if i.startswith('EQUATION')][0]
+    return parse_equation(' '.join(equ_line.split()[1:]))
+
+
+class ResponseCache:
+    """entries fetched from KEGG, or NOT_FOUND, keyed by requested id in a SQLite file safe to share between
+    processes"""
+    def __init__(self, loc=CACHE_LOC):
+        self.conn = sqlite3.connect(loc, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (id TEXT PRIMARY KEY, entry TEXT NOT NULL, "
+                          "fetched REAL NOT NULL)")
+        self.conn.commit()
+
+    def get_many(self, ids):
+        entries = dict()
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i+900]
+            rows = self.conn.execute("SELECT id, entry FROM entries WHERE id IN (%s)" % ','.join('?' * len(chunk)),
+                                     chunk)
+            entries.update(rows)
+        return entries
+
+    def put_many(self, entries):
+        fetched = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO entries (id, entry, fetched) VALUES (?, ?, ?)",
+                                  [(kegg_id, entry, fetched) for kegg_id, entry in entries.items()])
+
+    def close(self):
+        self.conn.close()
+
+
+class KEGGRestClient:
+    """batched, concurrency bounded and cached access to KEGG REST get"""
+    def __init__(self, base_url=BASE_URL, cache_loc=CACHE_LOC, concurrency=20, batch_size=BATCH_SIZE, timeout=60,
+                 retries=3, backoff=1.):
+        self.base_url = base_url.rstrip('/')
+        self.cache = ResponseCache(cache_loc)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    async def fetch_async(self, ids, concurrency=None):
+        """entry text for each of ids, NOT_FOUND for ids KEGG doesn't have, ids that could not be fetched are left
+        out"""
+        ids = list(dict.fromkeys(ids))
+        entries = self.cache.get_many(ids)
+        to_fetch = [i for i in ids if i not in entries]
+        if len(to_fetch) == 0:
+            return entries
+        aiohttp = import_aiohttp()
+        concurrency = self.concurrency if concurrency is None else concurrency
+        semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            batches = [to_fetch[i:i+self.batch_size] for i in range(0, len(to_fetch), self.batch_size)]
+            for fetched in await asyncio.gather(*[self.fetch_batch(aiohttp, session, semaphore, batch)
+                                                  for batch in batches]):
+                entries.update(fetched)
+        return entries
+
+    async def fetch_batch(self, aiohttp, session, semaphore, batch):
+        url = '%s/get/%s' % (self.base_url, '+'.join(batch))
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                async with semaphore:
+                    async with session.get(url) as r:
+                        if r.status == 200:
+                            text = await r.text()
+                            break
+                        elif r.status == 404:
+                            # none of the ids in the batch exist
+                            text = ''
+                            break
+                        elif r.status not in RETRY_STATUSES:
+                            warnings.warn("KEGG returned status %s for %s" % (r.status, url))
+                            return dict()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        else:
+            warnings.warn("Connection to kegg not able to be established for %s" % url)
+            return dict()
+
+        found = split_entries(text)
+        fetched = {kegg_id: found.get(strip_prefix(kegg_id), NOT_FOUND) for kegg_id in batch}
+        self.cache.put_many(fetched)
+        return fetched
+
+    def fetch(self, ids, concurrency=None):
+        return asyncio.run(self.fetch_async(ids, concurrency))
+
+    def get_rxns_from_genes(self, genes, concurrency=None):
+        """list of reactions of each KO or gene id"""
+        entries = self.fetch(genes, concurrency)
+        gene_rxns = dict()
+        for gene in genes:
+            entry = entries.get(gene)
+            if entry is None:
+                warnings.warn("Connection to kegg not able to be established.")
+                gene_rxns[gene] = list()
+            elif entry == NOT_FOUND:
+                warnings.warn("No gene found with id %s" % gene)
+                gene_rxns[gene] = list()
+            else:
+                gene_rxns[gene] = parse_gene_rxns(gene, entry)
+        return gene_rxns
+
+    def get_equations(self, rxns, concurrency=None):
+        """reactants, products and reversibility of each reaction id"""
+        entries = self.fetch(rxns, concurrency)
+        equations = dict()
+        for rxn in rxns:
+            entry = entries.get(rxn)
+            if entry is None:
+                warnings.warn("Connection to kegg not able to be established")
+                equations[rxn] = list(), list(), False
+            elif entry == NOT_FOUND:
+                warnings.warn("No reaction found with id %s" % rxn)
+                equations[rxn] = list(), list(), False
+            else:
+                equations[rxn] = parse_rxn_equation(entry)
+        return equations
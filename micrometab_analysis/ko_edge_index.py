@@ -0,0 +1,163 @@
+"""ko_edge_index.py
+Precomputed expansion of every KO to the compounds and reactant -> product edges of its reactions.  KOs and
+compounds are interned with kegg_ids and edges are packed into one integer (source << 32 | target), so the
+network of a genome is the unique union of its KOs' slices of two flat arrays instead of a walk over
+KO -> reactions -> reactants x products for every OTU.  Saved as a directory of .npy files that can be memory
+mapped.  load_cached keeps that directory next to the KEGG pickle snapshots and maps it read only, so every
+process building genomes shares one copy of the arrays through the page cache.
+"""
+
+import os
+import pickle
+import shutil
+import warnings
+
+import numpy as np
+
+from micrometab_analysis import parse_KEGG
+from micrometab_analysis.kegg_ids import decode_kos, encode_compound, encode_kos
+
+ARRAYS = ['kos', 'node_indptr', 'node_codes', 'edge_indptr', 'edge_codes']
+KEY_FILE = 'key.pkl'
+INDEX_VERSION = 2
+
+
+class KOEdgeIndex:
+    """CSR style arrays of compound codes and packed edges for each KO, rows in order of the sorted KO codes in
+    kos"""
+    def __init__(self, kos, node_indptr, node_codes, edge_indptr, edge_codes):
+        self.kos = kos
+        self.node_indptr = node_indptr
+        self.node_codes = node_codes
+        self.edge_indptr = edge_indptr
+        self.edge_codes = edge_codes
+
+    @classmethod
+    def from_maps(cls, ko2rxns, rxn2cos):
+        """build from parse_KEGG.get_ko2rxns and parse_KEGG.get_reactions maps"""
+        kos = sorted(ko2rxns)
+        node_indptr = [0]
+        node_codes = list()
+        edge_indptr = [0]
+        edge_codes = list()
+        for ko in kos:
+            nodes = set()
+            edges = set()
+            for rxn in ko2rxns[ko]:
+                if rxn not in rxn2cos:
+                    continue
+                reacts, prods, rev = rxn2cos[rxn]
+                # same nodes and edges make_metabolic_network makes from the reaction
+                for react in reacts:
+                    react = encode_compound(react)
+                    nodes.add(react)
+                    for prod in prods:
+                        prod = encode_compound(prod)
+                        nodes.add(prod)
+                        edges.add(react << 32 | prod)
+            node_codes.extend(sorted(nodes))
+            node_indptr.append(len(node_codes))
+            edge_codes.extend(sorted(edges))
+            edge_indptr.append(len(edge_codes))
+        return cls(encode_kos(kos), np.array(node_indptr, dtype=np.int64), np.array(node_codes, dtype=np.uint32),
+                   np.array(edge_indptr, dtype=np.int64), np.array(edge_codes, dtype=np.uint64))
+
+    @classmethod
+    def from_kegg(cls, kegg):
+        """build from the maps of a parse_KEGG.KEGGParser"""
+        kegg.load_reactome_maps()
+        return cls.from_maps(kegg.ko2rxns, kegg.rxn2cos)
+
+    def save(self, loc):
+        os.makedirs(loc, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(loc, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, loc, mmap_mode='r'):
+        return cls(*[np.load(os.path.join(loc, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAYS])
+
+    def get_rows(self, genome):
+        """rows of the KOs in genome, given as KO ids or codes, warning about any not in the index"""
+        genome = np.asarray(genome)
+        if genome.dtype.kind in 'iu':
+            codes = genome
+        else:
+            genome = genome.astype('U')
+            is_ko = np.char.startswith(genome, 'K')
+            for ko in genome[~is_ko].tolist():
+                warnings.warn("KO id " + ko + " doesn't exist in this set.")
+            codes = encode_kos(genome[is_ko])
+        rows = np.searchsorted(self.kos, codes)
+        found = rows < len(self.kos)
+        found[found] = self.kos[rows[found]] == codes[found]
+        for ko in decode_kos(codes[~found]):
+            warnings.warn("KO id " + ko + " doesn't exist in this set.")
+        return rows[found]
+
+    def get_network(self, genome):
+        """Compounds and edges of the reactions of the KOs in genome
+
+        Returns
+        -------
+        nodes: sorted array of compound codes
+        sources, targets: arrays of positions in nodes for each edge
+        """
+        rows = self.get_rows(genome)
+        nodes = np.unique(gather_rows(self.node_indptr, self.node_codes, rows))
+        edges = np.unique(gather_rows(self.edge_indptr, self.edge_codes, rows))
+        sources = np.searchsorted(nodes, (edges >> np.uint64(32)).astype(np.uint32))
+        targets = np.searchsorted(nodes, (edges & np.uint64(0xffffffff)).astype(np.uint32))
+        return nodes, sources, targets
+
+
+def gather_rows(indptr, data, rows):
+    """data of CSR rows concatenated in one fancy index"""
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return data[offsets + np.arange(offsets.size)]
+
+
+def get_index_dir():
+    return os.path.join(parse_KEGG.get_cache_dir(), 'ko_edge_index')
+
+
+def get_cache_key():
+    """index version plus the cache keys of the KEGG files the index is built from"""
+    return [INDEX_VERSION, parse_KEGG.get_cache_key(parse_KEGG.get_ko2rxns),
+            parse_KEGG.get_cache_key(parse_KEGG.get_reactions)]
+
+
+def read_key(loc):
+    try:
+        with open(os.path.join(loc, KEY_FILE), 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def load_cached(rebuild=False, mmap_mode='r'):
+    """KO edge index for the KEGG files in parse_KEGG.DATABASE_DIR, memory mapped from the cache directory.  The
+    index is rebuilt from the KEGG maps first if it is missing or its KEGG files have changed.  If it can't be
+    written the index is kept in memory instead.
+    """
+    loc = get_index_dir()
+    key = get_cache_key()
+    if not rebuild and read_key(loc) == key:
+        return KOEdgeIndex.load(loc, mmap_mode)
+    maps = parse_KEGG.load_cached_maps([parse_KEGG.get_ko2rxns, parse_KEGG.get_reactions])
+    index = KOEdgeIndex.from_maps(maps[parse_KEGG.get_ko2rxns], maps[parse_KEGG.get_reactions])
+    try:
+        # write beside the old index then swap it in so no reader sees a partial set of arrays
+        tmp_loc = "%s.%s.tmp" % (loc, os.getpid())
+        index.save(tmp_loc)
+        with open(os.path.join(tmp_loc, KEY_FILE), 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(loc):
+            shutil.rmtree(loc)
+        os.replace(tmp_loc, loc)
+    except (IOError, OSError):
+        warnings.warn("Unable to write KO edge index to %s" % loc)
+        return index
+    return KOEdgeIndex.load(loc, mmap_mode)
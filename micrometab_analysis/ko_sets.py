@@ -0,0 +1,67 @@
+"""ko_sets.py
+KO content of a genome packed as a bitset over KO codes (see kegg_ids): bit i is set when K{i:05d} is present, 8
+codes to a byte with the lowest code in the lowest bit, and trailing zero bytes dropped.  KO numbers stay under
+30000, so a genome packs into at most a few KB however many KOs it carries, against 7 bytes per KO as a comma
+joined string.
+
+Sets are combined and counted as packed bytes with numpy, without decoding them to ids.
+"""
+
+import numpy as np
+
+from micrometab_analysis.kegg_ids import CODE_DTYPE, decode_kos
+
+# set bits in every byte value
+_BIT_COUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+
+
+def _bits(packed, n_bytes=None):
+    bits = np.frombuffer(packed, dtype=np.uint8)
+    if n_bytes is not None and n_bytes > len(bits):
+        bits = np.concatenate([bits, np.zeros(n_bytes - len(bits), dtype=np.uint8)])
+    return bits
+
+
+def _pack_bits(bits):
+    nonzero = np.flatnonzero(bits)
+    return bits[:nonzero[-1] + 1].tobytes() if len(nonzero) > 0 else b''
+
+
+def pack_kos(codes):
+    """bitset of an array of KO codes"""
+    codes = np.asarray(codes, dtype=np.int64)
+    if len(codes) == 0:
+        return b''
+    present = np.zeros(codes.max() + 1, dtype=bool)
+    present[codes] = True
+    return np.packbits(present, bitorder='little').tobytes()
+
+
+def unpack_kos(packed):
+    """sorted array of the KO codes in a bitset"""
+    return np.flatnonzero(np.unpackbits(_bits(packed), bitorder='little')).astype(CODE_DTYPE)
+
+
+def kos_to_str(packed):
+    """comma joined KO ids of a bitset, the form genomes were stored in before they were packed"""
+    return ','.join(decode_kos(unpack_kos(packed)))
+
+
+def count(packed):
+    return int(_BIT_COUNTS[_bits(packed)].sum())
+
+
+def intersection(packed1, packed2):
+    n_bytes = min(len(packed1), len(packed2))
+    return _pack_bits(_bits(packed1)[:n_bytes] & _bits(packed2)[:n_bytes])
+
+
+def union(packed1, packed2):
+    n_bytes = max(len(packed1), len(packed2))
+    return _pack_bits(_bits(packed1, n_bytes) | _bits(packed2, n_bytes))
+
+
+def difference(packed1, packed2):
+    """KOs in packed1 but not packed2"""
+    bits1 = _bits(packed1)
+    return _pack_bits(bits1 & ~_bits(packed2, len(bits1))[:len(bits1)])
@@ -1,11 +1,25 @@
 import networkx as nx
 from collections import defaultdict
+import gc
 import warnings
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 import requests
 from multiprocessing.pool import ThreadPool
 from micrometab_analysis.parse_KEGG import KEGGParser
+from micrometab_analysis.kegg_ids import decode_compounds
+from micrometab_analysis.compact_graph import CompactGraph
+from micrometab_analysis.seed_detection import NOT_SEED, find_seed_groups, find_seed_groups_batch, \
+    seed_sets_from_groups
+from micrometab_analysis import ko_edge_index as kei
+from micrometab_analysis.kegg_rest import KEGGRestClient
 
 kegg = None
+kegg_rest = None
+ko_edge_index = None
+COS_TO_REMOVE_LOC = "cos_to_remove.txt"
+cos_to_remove = dict()
 
 genes_seen = {}
 def get_kegg_rxns_from_gene_togows(gene):
@@ -32,32 +46,7 @@ def get_kegg_rxns_from_gene_togows(gene):
 
 
 def get_kegg_rxns_from_gene_kegg(gene):
-    global genes_seen
-    if gene in genes_seen:
-        return genes_seen[gene]
-    else:
-        r = requests.get('http://rest.kegg.jp/get/%s' % gene)
-        if r.status_code == 200:
-            if len(r.text) == 0:
-                warnings.warn("No gene found with id %s" % gene)
-                return list()
-            else:
-                rxn_line = [i for i in r.text.split('\n') if "RN:" in i.strip().split()]
-                if len(rxn_line) == 1:
-                    rxns = rxn_line[0][12:].split()[1:]
-                    genes_seen[gene] = rxns
-                    return rxns
-                elif len(rxn_line) == 0:
-                    return list()
-                else:
-                    warnings.warn("More than one reaction DBLINKS RN for %s" % gene)
-                    return list()
-        elif r.status_code == 404:
-            warnings.warn("Connection to kegg not able to be established.")
-            return list()
-        else:
-            warnings.warn("No gene found with id %s" % gene)
-            return list()
+    return get_kegg_rest().get_rxns_from_genes([gene])[gene]
 
 
 rxns_seen = {}
@@ -96,52 +85,58 @@ def get_kegg_rxn_togows(rxn):
 
 
 def get_kegg_rxn_kegg(rxn):
-    global rxns_seen
-    if rxn in rxns_seen:
-        return rxns_seen[rxn]
-    else:
-        r = requests.get('http://rest.kegg.jp/get/%s' % rxn)
-        if r.status_code == 200:
-            if len(r.text) == 0:
-                warnings.warn("No reaction found with id %s" % rxn)
-                rxns_seen[rxn] = list(), list(), False
-                return list(), list(), False
-            else:
-                equ_line = [i for i in r.text.split('\n') if i.startswith('EQUATION')][0]
-                equ_str = ' '.join(equ_line.split()[1:])
-                equ = equ_str.split('=>')
-                if equ[0][-1] == '<':
-                    rev = True
-                    equ[0] = equ[0][:-1]
-                else:
-                    rev = False
-                reacts = list()
-                for part in equ[0].strip().split():
-                    if part[0] == 'C' or part[0] == 'G':
-                        reacts.append(part[:6])
-                prods = list()
-                for part in equ[1].strip().split():
-                    if part[0] == 'C' or part[0] == 'G':
-                        prods.append(part[:6])
-                rxns_seen[rxn] = reacts, prods, rev
-                return reacts, prods, rev
-        else:
-            warnings.warn("Connection to kegg via togows not able to be established")
-            return list(), list(), False
+    return get_kegg_rest().get_equations([rxn])[rxn]
 
 
-def get_reactome_local(genome, loc=None):
+def get_kegg(loc=None):
+    """KEGGParser shared by the local functions, its maps are parsed on first use"""
     global kegg
     if kegg is None:
         if loc is None:
             raise ValueError("Need to provide location for database files if using local")
         kegg = KEGGParser(loc)
+    return kegg
+
+
+def get_reactome_local(genome, loc=None):
+    kegg = get_kegg(loc)
     reactome = list()
     for gene in genome:
         reactome.extend(kegg.get_rxns_from_ko(gene))
     return set(reactome)
 
 
+def get_ko_edge_index(loc=None):
+    """KO edge index memory mapped from the KEGG cache directory, see ko_edge_index.load_cached"""
+    global ko_edge_index
+    if ko_edge_index is None:
+        get_kegg(loc)
+        ko_edge_index = kei.load_cached()
+    return ko_edge_index
+
+
+def load_for_workers(loc, local_maps=False):
+    """Load the KEGG data genome building needs once, in the process that is about to fork a worker pool.  Forked
+    workers inherit the KO edge index mapping, and the KO and reaction maps if local_maps is set for the
+    get_*_local functions, instead of each parsing their own copy.  gc.freeze keeps the collector in the workers
+    from writing to, and so copying, the pages of everything loaded here.  Everything the process holds is left out
+    of garbage collection until gc.unfreeze is called, which the caller does once the pool has forked.
+    """
+    get_ko_edge_index(loc)
+    if local_maps:
+        get_kegg(loc).load_reactome_maps()
+    gc.freeze()
+
+
+def get_kegg_rest(base_url=None, cache_loc=None):
+    """KEGG REST client shared by the remote functions, base_url and cache_loc only apply to the first call"""
+    global kegg_rest
+    if kegg_rest is None:
+        kwargs = {key: value for key, value in (('base_url', base_url), ('cache_loc', cache_loc)) if value is not None}
+        kegg_rest = KEGGRestClient(**kwargs)
+    return kegg_rest
+
+
 def get_reactome_togows(genome, threads=20):
     reactome = list()
     pool = ThreadPool(processes=threads)
@@ -152,20 +147,12 @@ def get_reactome_togows(genome, threads=20):
 
 
 def get_reactome_kegg(genome, threads=20):
-    reactome = list()
-    pool = ThreadPool(processes=threads)
-    pool.map_async(get_kegg_rxns_from_gene_kegg, genome, callback=reactome.extend)
-    pool.close()
-    pool.join()
-    return set([j for i in reactome for j in i])
+    """reactions of the KOs in genome from the KEGG REST API, threads requests at a time"""
+    return set([j for i in get_kegg_rest().get_rxns_from_genes(list(genome), threads).values() for j in i])
 
 
 def get_rxns_local(reactome, loc=None):
-    global kegg
-    if kegg is None:
-        if loc is None:
-            raise ValueError("Need to provide location for database files if using local")
-        kegg = KEGGParser(loc)
+    kegg = get_kegg(loc)
     rxns = list()
     for rxn in reactome:
         rxns.append(kegg.get_rxn(rxn))
@@ -182,81 +169,161 @@ def get_rxns_togows(reactome, threads=20):
 
 
 def get_rxns_kegg(reactome, threads=20):
-    rxns = list()
-    pool = ThreadPool(processes=threads)
-    pool.map_async(get_kegg_rxn_kegg, reactome, callback=rxns.append)
-    pool.close()
-    pool.join()
-    return [j for i in rxns for j in i]
+    """equations of the reactions in reactome from the KEGG REST API, threads requests at a time"""
+    reactome = list(reactome)
+    equations = get_kegg_rest().get_equations(reactome, threads)
+    return [equations[rxn] for rxn in reactome]
+
+
+def get_cos_to_remove(loc=COS_TO_REMOVE_LOC):
+    """very common compounds to filter from networks, read once per process"""
+    if loc not in cos_to_remove:
+        try:
+            with open(loc) as f:
+                cos_to_remove[loc] = frozenset([i.strip() for i in f])
+        except IOError:
+            warnings.warn("cos_to_remove.txt not found. Run determine_cos_to_remove.py to create.")
+            cos_to_remove[loc] = frozenset()
+    return cos_to_remove[loc]
+
+
+def weak_components(n_nodes, sources, targets):
+    """label every node with the lowest numbered node in its weakly connected component"""
+    adjacency = sparse.csr_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(n_nodes, n_nodes))
+    _, labels = connected_components(adjacency, directed=True, connection='weak')
+    first_node = np.full(n_nodes, n_nodes, dtype=np.int64)
+    np.minimum.at(first_node, labels, np.arange(n_nodes))
+    return first_node[labels]
 
 
 def make_metabolic_network(rxns, filter_very_common=True, filter_common=False, only_giant=False,
-                           min_component_size=None):
-    metab_net = nx.DiGraph()
-    for reacts, prods, rev in rxns:
+                           min_component_size=None, cos_to_remove_loc=COS_TO_REMOVE_LOC):
+    # number compounds in order of appearance and collect reactant -> product edges as a set of number pairs
+    node_index = dict()
+    edges = set()
+    for rxn in rxns:
+        if rxn is None:
+            continue
+        reacts, prods, rev = rxn
         for react in reacts:
-            if react not in metab_net.nodes():
-                metab_net.add_node(react)
+            react = node_index.setdefault(react, len(node_index))
             for prod in prods:
-                if prod not in metab_net.nodes():
-                    metab_net.add_node(prod)
-                if (react, prod) not in metab_net.edges():
-                    metab_net.add_edge(react, prod)
+                edges.add((react, node_index.setdefault(prod, len(node_index))))
+    return filter_network(list(node_index), edges, filter_very_common, filter_common, only_giant, min_component_size,
+                          cos_to_remove_loc)
+
+
+def make_metabolic_network_from_kos(genome, ko_edge_index, filter_very_common=True, filter_common=False,
+                                    only_giant=False, min_component_size=None, cos_to_remove_loc=COS_TO_REMOVE_LOC):
+    """same network as make_metabolic_network(get_rxns_local(get_reactome_local(genome))) made from a KOEdgeIndex"""
+    node_codes, sources, targets = ko_edge_index.get_network(genome)
+    nodes = decode_compounds(node_codes)
+    return filter_network(nodes, list(zip(sources.tolist(), targets.tolist())), filter_very_common, filter_common,
+                          only_giant, min_component_size, cos_to_remove_loc)
+
+
+def make_compact_network_from_kos(genome, ko_edge_index, filter_very_common=True, filter_common=False,
+                                  only_giant=False, min_component_size=None, cos_to_remove_loc=COS_TO_REMOVE_LOC):
+    """make_metabolic_network_from_kos as a CompactGraph, without seeds, never building a networkx graph"""
+    node_codes, sources, targets = ko_edge_index.get_network(genome)
+    keep, sources, targets = filter_network_arrays(decode_compounds(node_codes), sources, targets,
+                                                   filter_very_common, filter_common, only_giant,
+                                                   min_component_size, cos_to_remove_loc)
+    position = np.cumsum(keep) - 1
+    return CompactGraph.from_code_edges(node_codes[keep], position[sources], position[targets])
+
+
+def filter_network_arrays(nodes, sources, targets, filter_very_common=True, filter_common=False, only_giant=False,
+                          min_component_size=None, cos_to_remove_loc=COS_TO_REMOVE_LOC):
+    """Apply the make_metabolic_network filters to edges given as arrays of positions in nodes
+
+    Returns
+    -------
+    keep: boolean array of the nodes left in the network
+    sources, targets: arrays of the edges left, sorted by source then target
+    """
+    n_nodes = len(nodes)
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    keep = np.ones(n_nodes, dtype=bool)
+
+    def kept_edges():
+        kept = keep[sources] & keep[targets]
+        return sources[kept], targets[kept]
 
     if filter_very_common:
-        try:
-            f = open("cos_to_remove.txt")
-            nodes_to_remove = set([i.strip() for i in f.readlines()])
-            metab_net.remove_nodes_from(nodes_to_remove)
-        except IOError:
-            warnings.warn("cos_to_remove.txt not found. Run determine_cos_to_remove.py to create.")
+        nodes_to_remove = get_cos_to_remove(cos_to_remove_loc)
+        keep = np.array([node not in nodes_to_remove for node in nodes], dtype=bool)
+        sources, targets = kept_edges()
 
     if filter_common:
-        for node, degree in metab_net.degree_iter():
-            if degree > 10:  # picked 20 by looking at degree distribution of some otus
-                metab_net.remove_node(node)
-
-    if only_giant:
-        components = list(nx.weakly_connected_components(metab_net))
-        giant_component = set()
-        for component in components:
-            if len(component) > len(giant_component):
-                giant_component = component
-        metab_net.remove_nodes_from(set(metab_net.nodes()) - giant_component)
-
-    if not only_giant and type(min_component_size) == int:
-        components = list(nx.weakly_connected_components(metab_net))
-        nodes_to_remove = list()
-        for component in components:
-            if len(component) < min_component_size:
-                nodes_to_remove += list(component)
-        metab_net.remove_nodes_from(nodes_to_remove)
-
+        degrees = np.bincount(sources, minlength=n_nodes) + np.bincount(targets, minlength=n_nodes)
+        # picked by looking at degree distribution of some otus
+        keep &= degrees <= 10
+        sources, targets = kept_edges()
+
+    if only_giant or type(min_component_size) == int:
+        components = weak_components(n_nodes, sources, targets)
+        sizes = np.bincount(components[keep], minlength=n_nodes)
+        if only_giant and keep.any():
+            # largest component, ties going to the one seen first like nx.weakly_connected_components, components
+            # being labelled by their first node argmax gives exactly that
+            keep &= components == np.argmax(sizes)
+        elif not only_giant:
+            keep &= sizes[components] >= min_component_size
+        sources, targets = kept_edges()
+
+    order = np.lexsort((targets, sources))
+    return keep, sources[order], targets[order]
+
+
+def filter_network(nodes, edges, filter_very_common=True, filter_common=False, only_giant=False,
+                   min_component_size=None, cos_to_remove_loc=COS_TO_REMOVE_LOC):
+    """apply the make_metabolic_network filters to edges given as pairs of positions in nodes and build the graph"""
+    edges = list(edges)
+    keep, sources, targets = filter_network_arrays(nodes, [i for i, _ in edges], [j for _, j in edges],
+                                                   filter_very_common, filter_common, only_giant,
+                                                   min_component_size, cos_to_remove_loc)
+    metab_net = nx.DiGraph()
+    metab_net.add_nodes_from([node for node, kept in zip(nodes, keep.tolist()) if kept])
+    metab_net.add_edges_from([(nodes[i], nodes[j]) for i, j in zip(sources.tolist(), targets.tolist())])
     return metab_net
 
 
 def determine_seed_set(metab_net):
-    sscs = list(nx.strongly_connected_components(metab_net))
-    seed_sets = defaultdict(list)
-    seed_group = 0
-    for ssc in sscs:
-        in_nodes = set([i[0] for i in metab_net.in_edges(ssc)])
-        if len(in_nodes - set(ssc)) == 0:
-            for co in ssc:
-                metab_net.node[co]['Seed'] = 1
-                metab_net.node[co]['SeedGroup'] = seed_group
-                seed_sets[seed_group].append(co)
-            seed_group += 1
-        else:
-            for co in ssc:
-                metab_net.node[co]['Seed'] = 0
-    return metab_net, seed_sets
+    """Seeds of a networkx metabolic network, flagged with Seed and SeedGroup node attributes, see seed_detection
+
+    Returns
+    -------
+    metab_net: the same network with Seed and SeedGroup set
+    seed_sets: dictionary of seed group number to the list of compounds in it
+    """
+    nodes = list(metab_net.nodes())
+    node_index = {node: i for i, node in enumerate(nodes)}
+    edges = sorted([(node_index[i], node_index[j]) for i, j in metab_net.edges()])
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount([i for i, _ in edges], minlength=len(nodes)))
+    seed_groups = find_seed_groups(len(nodes), indptr, [j for _, j in edges]).tolist()
+    # add_nodes_from updates the attributes of nodes already in the graph
+    metab_net.add_nodes_from([(node, {'Seed': 1, 'SeedGroup': seed_group} if seed_group != NOT_SEED else {'Seed': 0})
+                              for node, seed_group in zip(nodes, seed_groups)])
+    return metab_net, defaultdict(list, seed_sets_from_groups(np.array(seed_groups, dtype=np.int64), nodes))
+
+
+def find_seeds_batch(graphs):
+    """find the seeds of many CompactGraphs at once, see seed_detection.find_seed_groups_batch"""
+    for graph, seed_groups in zip(graphs, find_seed_groups_batch([graph.csr() for graph in graphs])):
+        graph.seed_groups = seed_groups
+    return graphs
 
 
 def calculate_bss(network1, seeds1, network2, seeds2):
+    return calculate_bss_from_nodes(set(network1.nodes()), seeds1, set(network2.nodes()), seeds2)
+
+
+def calculate_bss_from_nodes(network1_nodes, seeds1, network2_nodes, seeds2):
     # calculate bss for otu1 relative to otu2
     overlap_seed1net2 = 0
-    network2_nodes = set(network2.nodes())
     for seeds in list(seeds1.values()):
         if len(set(seeds) & network2_nodes) > 0:
             overlap_seed1net2 += 1
@@ -264,7 +331,6 @@ def calculate_bss(network1, seeds1, network2, seeds2):
 
     # calculate bss for otu2 relative to otu1
     overlap_seed2net1 = 0
-    network1_nodes = set(network1.nodes())
     for seeds in list(seeds2.values()):
         if len(set(seeds) & network1_nodes) > 0:
             overlap_seed2net1 += 1
@@ -274,9 +340,12 @@ def calculate_bss(network1, seeds1, network2, seeds2):
 
 
 def calculate_mci(network1, seeds1, network2, seeds2):
+    return calculate_mci_from_nodes(set(network1.nodes()), seeds1, set(network2.nodes()), seeds2)
+
+
+def calculate_mci_from_nodes(otu1_nodes, seeds1, otu2_nodes, seeds2):
     # calculate mci for otu1 relative to otu2
     otu2_inseeds = set.union(*[set(i) for i in list(seeds2.values())])
-    otu2_nodes = set(network2.nodes())
     overlap_seed1seed2 = 0
     for seeds in list(seeds1.values()):
         if len(set(seeds) & otu2_nodes) > 0:  # check if any of seed group in other network
@@ -286,7 +355,6 @@ def calculate_mci(network1, seeds1, network2, seeds2):
 
     # calculate mci for otu2 relative to otu1
     otu1_inseeds = set.union(*[set(i) for i in list(seeds1.values())])
-    otu1_nodes = set(network1.nodes())
     overlap_seed2seed1 = 0
     for seeds in list(seeds2.values()):
         if len(set(seeds) & otu1_nodes) > 0:
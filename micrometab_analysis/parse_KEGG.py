@@ -1,17 +1,21 @@
 """parse_KEGG.py
 Parses the reaction file from KEGG in order to produce a number of data structures.  This script is
 designed so that any of it's functions may be imported and so that any of the data structures it
-can generate may be written to pickle's for fast use by other scripts.
+can generate may be written to pickle's for fast use by other scripts.  load_cached keeps those pickles
+up to date with the KEGG files and running this module as a script prebuilds them.
 
 pathways are just a 5 digit number, orthology is a 5 digit number preceded by K, reaction is a
 5 digit number preceded by an R, compounds are a 5 digit number preceded by a C, and glycans
 are a 5 digit number preceded by a G
 """
 
-# TODO: Add main method to make pickles for some/all methods
 # TODO: Rewrite to use KEGG API with local fallback
 
 from collections import defaultdict, namedtuple, Counter
+import argparse
+import hashlib
+import os
+import pickle
 import warnings
 
 DATABASE_DIR = "/Users/shafferm/lab/microbiome_metab/databases/"
@@ -21,14 +25,21 @@ REACTION_LOC = "reaction"
 KO_LOC = "ko"
 REACTION_MAPFORMULA_LOC = "reaction_mapformula.lst"
 HUMAN_GENOME_LOC = "h.sapiens"
+CACHE_DIR = None
+CACHE_VERSION = 1
+
+Compound = namedtuple('Compound', 'co, name, formula, mass, rxn, pathways')
 
 
 class KEGGParser:
     """class to retrieve from dictionaries in KEGG"""
-    def __init__(self, database_dir=None):
+    def __init__(self, database_dir=None, use_cache=True, cache_dir=None):
+        global DATABASE_DIR, CACHE_DIR
         if database_dir is not None:
-            global DATABASE_DIR
             DATABASE_DIR = database_dir
+        if cache_dir is not None:
+            CACHE_DIR = cache_dir
+        self.use_cache = use_cache
         self.rxn2cos = None
         self.ko2rxns = None
         self.pathway2kos = None
@@ -41,9 +52,24 @@ class KEGGParser:
         self.rxns = None
         self.pathway2cos = None
 
+    def load(self, getter):
+        if self.use_cache:
+            return load_cached(getter)
+        return getter()
+
+    def load_reactome_maps(self):
+        """parse the KO and reaction maps in one pass, so a parent process can hold them before forking workers"""
+        if self.ko2rxns is None or self.rxn2cos is None:
+            if self.use_cache:
+                maps = load_cached_maps([get_ko2rxns, get_reactions])
+            else:
+                maps = build_maps([get_ko2rxns, get_reactions])
+            self.ko2rxns = maps[get_ko2rxns]
+            self.rxn2cos = maps[get_reactions]
+
     def get_rxns_from_ko(self, ko):
         if self.ko2rxns is None:
-            self.ko2rxns = get_ko2rxns()
+            self.ko2rxns = self.load(get_ko2rxns)
         try:
             return self.ko2rxns[ko]
         except KeyError:
@@ -52,7 +78,7 @@ class KEGGParser:
 
     def get_co_info(self, co):
         if self.co_names is None:
-            self.co_names = get_co_info()
+            self.co_names = self.load(get_co_info)
         # try:
         return self.co_names[co]
         # except KeyError:
@@ -61,7 +87,7 @@ class KEGGParser:
 
     def get_kos_from_pathway(self, pathway):
         if self.pathway2kos is None:
-            self.pathway2kos = get_pathway2kos()
+            self.pathway2kos = self.load(get_pathway2kos)
         try:
             return self.pathway2kos[pathway[-5:]]
         except KeyError:
@@ -70,7 +96,7 @@ class KEGGParser:
 
     def get_rxns_from_pathway(self, pathway):
         if self.pathway2rxns is None:
-            self.pathway2rxns = get_pathway2rxns()
+            self.pathway2rxns = self.load(get_pathway2rxns)
         try:
             return self.pathway2rxns[pathway[-5:]]
         except KeyError:
@@ -79,7 +105,7 @@ class KEGGParser:
 
     def get_kos_from_rxn(self, rxn):
         if self.rxn2kos is None:
-            self.rxn2kos = get_rxn2kos()
+            self.rxn2kos = self.load(get_rxn2kos)
         # try:
         return self.rxn2kos[rxn]
         # except KeyError:
@@ -88,7 +114,7 @@ class KEGGParser:
 
     def get_rxn(self, rxn):
         if self.rxn2cos is None:
-            self.rxn2cos = get_reactions()
+            self.rxn2cos = self.load(get_reactions)
         try:
             return self.rxn2cos[rxn]
         except KeyError:
@@ -97,7 +123,7 @@ class KEGGParser:
 
     def get_rxn_name(self, rxn):
         if self.rxn_names is None:
-            self.rxn_names = get_rxn_names()
+            self.rxn_names = self.load(get_rxn_names)
         try:
             return self.rxn_names[rxn]
         except KeyError:
@@ -106,7 +132,7 @@ class KEGGParser:
 
     def get_ko_name(self, ko):
         if self.ko_names is None:
-            self.ko_names = get_ko_names()
+            self.ko_names = self.load(get_ko_names)
         try:
             return self.ko_names[ko]
         except KeyError:
@@ -115,12 +141,12 @@ class KEGGParser:
     
     def get_pathway_name(self, pathway):
         if self.pathway_names is None:
-            self.pathway_names = get_ko_names()
+            self.pathway_names = self.load(get_ko_names)
         return self.pathway_names[pathway]
 
     def get_cos_from_pathway(self, co):
         if self.pathway2cos is None:
-            self.pathway2cos = get_pathway2cos()
+            self.pathway2cos = self.load(get_pathway2cos)
         try:
             return self.pathway2cos[co]
         except KeyError:
@@ -128,575 +154,281 @@ class KEGGParser:
             return set()
 
 
-def get_reactions():
-    """get compounds for each reaction and each KO"""
-    f = open(DATABASE_DIR+REACTION_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
+def iter_records(f):
+    """Yield the entries of a KEGG flat file one at a time, reading f line by line.  Each entry is a dict of field
+    name (the first 12 characters of a line) to the list of its lines with the field column removed, continuation
+    lines being appended to the field above them.  Entries without an ENTRY field are skipped.
+    """
+    record = dict()
+    lines = None
+    for line in f:
+        if line.startswith('///'):
+            if 'ENTRY' in record:
+                yield record
+            record = dict()
+            lines = None
+            continue
+        field = line[:12].strip()
+        value = line[12:].strip()
+        if field != "":
+            lines = record.setdefault(field, list())
+            lines.append(value)
+        elif lines is not None and value != "":
+            lines.append(value)
+    if 'ENTRY' in record:
+        yield record
+
+
+def get_entry_id(record):
+    return record['ENTRY'][0].split()[0]
+
+
+def parse_equation(line):
+    """reactants, products and reversibility of a reaction EQUATION line"""
+    equ = line.split('=>')
+    rev = False
+    if equ[0][-1] == '<':
+        rev = True
+        equ[0] = equ[0][:-1]
+    reacts = [part[:6] for part in equ[0].strip().split() if part[0] == 'C' or part[0] == 'G']
+    prods = [part[:6] for part in equ[1].strip().split() if part[0] == 'C' or part[0] == 'G']
+    return reacts, prods, rev
+
+
+def build_maps(getters):
+    """Parse each KEGG file needed by getters once, passing every entry to all of the requested maps as it is read.
+    Returns a dictionary of getter to the map it returns.
+    """
+    maps = dict()
+    builders = dict()
+    for getter in getters:
+        if getter in RECORD_BUILDERS:
+            builders[getter] = RECORD_BUILDERS[getter]()
+        else:
+            maps[getter] = getter()
+
+    locs = list()
+    for getter in builders:
+        for loc in CACHED_SOURCES[getter]:
+            if loc not in locs:
+                locs.append(loc)
+    for loc in locs:
+        add_records = [add_record for getter, (_, add_record) in builders.items() if loc in CACHED_SOURCES[getter]]
+        with open(DATABASE_DIR+loc) as f:
+            for record in iter_records(f):
+                for add_record in add_records:
+                    add_record(loc, record)
+
+    for getter, (data, _) in builders.items():
+        maps[getter] = data
+    return maps
+
+
+def reactions_builder():
     rxn2co = dict()
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        kos = []
-        r = ""
-        reacts = []
-        prods = []
-        rev = False
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                r = line.strip().split()[0]
-                start = "ENTRY"
-            elif new_start == "EQUATION":
-                equ = line.split('=>')
-                if equ[0][-1] == '<':
-                    rev = True
-                    equ[0] = equ[0][:-1]
-                reacts = list()
-                for part in equ[0].strip().split():
-                    if part[0] == 'C' or part[0] == 'G':
-                        reacts.append(part[:6])
-                prods = list()
-                for part in equ[1].strip().split():
-                    if part[0] == 'C' or part[0] == 'G':
-                        prods.append(part[:6])
-                start = "EQUATION"
-            elif new_start == "ORTHOLOGY":
-                kos.append(line.strip().split()[0])
-                start = "ORTHOLOGY"
-            elif new_start == "":
-                if start == "ORTHOLOGY":
-                    kos.append(line.strip().split()[0])
-            else:
-                start = new_start
-            i += 1
-        rxn2co[r] = reacts, prods, rev
-
-    return rxn2co
 
-
-def get_ko2rxns():
-    f = open(DATABASE_DIR+KO_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    ko2rxns = {}
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        ko = None
-        rxns = None
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                ko = line.strip().split()[0]
-                start = "ENTRY"
-            elif new_start == "DBLINKS":
-                line = line.split()
-                if line[0] == "RN:":
-                    rxns = line[1:]
-            elif new_start == "":
-                if start == "DBLINKS":
-                    if line[0] == "RN:":
-                        rxns = line[1:]
-            else:
-                start = new_start
-            i += 1
-        if rxns is not None:
-            ko2rxns[ko] = set(rxns)
+    def add_record(loc, record):
+        if 'EQUATION' in record:
+            rxn2co[get_entry_id(record)] = parse_equation(record['EQUATION'][0])
         else:
-            ko2rxns[ko] = set()
-
-    return ko2rxns
+            rxn2co[get_entry_id(record)] = list(), list(), False
+    return rxn2co, add_record
 
 
-def get_class2kos():
-    f = open(DATABASE_DIR+KO_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    class2kos = defaultdict(list)
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        ko = None
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                ko = line.strip().split()[0]
-                start = "ENTRY"
-            elif new_start == "CLASS":
-                line = line.split("; ")
-                class2kos[line[1]].append(ko)
-
-            elif new_start == "":
-                if start == "CLASS":
-                    line = line.split("; ")
-                    class2kos[line[1]].append(ko)
-            else:
-                start = new_start
-            i += 1
+def ko2rxns_builder():
+    ko2rxns = dict()
 
-    return class2kos
+    def add_record(loc, record):
+        rxns = set()
+        # reactions are only taken from the first DBLINKS line
+        if 'DBLINKS' in record:
+            line = record['DBLINKS'][0].split()
+            if line[0] == "RN:":
+                rxns = set(line[1:])
+        ko2rxns[get_entry_id(record)] = rxns
+    return ko2rxns, add_record
 
 
-def get_pathway2kos():
-    f = open(DATABASE_DIR+KO_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    pathway2kos = defaultdict(set)
-
-    for entry in f:
-        i = 0
-        start = ""
-        ko = ""
-        entry = entry.strip().split('\n')
-        paths = []
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                ko = line.strip().split()[0]
-                start = "ENTRY"
-            elif new_start == "PATHWAY":
-                paths.append(line.strip().split()[0][-5:])
-                start = "PATHWAY"
-            elif new_start == "":
-                if start == "PATHWAY":
-                    paths.append(line.strip().split()[0][-5:])
-            else:
-                start = new_start
-            i += 1
-        for path in paths:
-            pathway2kos[path].add(ko)
+def class2kos_builder():
+    class2kos = defaultdict(list)
 
-    return pathway2kos
+    def add_record(loc, record):
+        if 'CLASS' in record:
+            class2kos[record['CLASS'][0].split("; ")[1]].append(get_entry_id(record))
+    return class2kos, add_record
 
 
-def get_pathway2rxns():
-    f = open(DATABASE_DIR+REACTION_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    pathway2rxns = defaultdict(set)
-
-    for entry in f:
-        i = 0
-        entry = entry.strip().split('\n')
-        paths = []
-        start = ""
-        r = ""
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                r = line.strip().split()[0]
-                start = "ENTRY"
-            elif new_start == "PATHWAY":
-                paths.append(line.strip().split()[0][-5:])
-                start = "PATHWAY"
-            elif new_start == "":
-                if start == "PATHWAY":
-                    paths.append(line.strip().split()[0][-5:])
-            else:
-                start = new_start
-            i += 1
-        for path in paths:
-            pathway2rxns[path].add(r)
+def pathway2ids_builder():
+    pathway2ids = defaultdict(set)
 
-    return pathway2rxns
+    def add_record(loc, record):
+        for line in record.get('PATHWAY', list()):
+            pathway2ids[line.split()[0][-5:]].add(get_entry_id(record))
+    return pathway2ids, add_record
 
 
-def get_rxn2kos():
-    """"""
-    f = open(DATABASE_DIR+REACTION_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
+def rxn2kos_builder():
     rxn2kos = defaultdict(set)
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        kos = []
-        has_ortho = False
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                r = line.strip().split()[0]
-                start = "ENTRY"
-            elif new_start == "ORTHOLOGY":
-                kos.append(line.strip().split()[0])
-                has_ortho = True
-                start = "ORTHOLOGY"
-            elif new_start == "":
-                if start == "ORTHOLOGY":
-                    kos.append(line.strip().split()[0])
-            else:
-                start = new_start
-            i += 1
 
-        if has_ortho is True:
-            if len(r) != 6 and r.startswith('R') is False:
-                print(r)
-            for ko in kos:
-                rxn2kos[r].add(ko)
+    def add_record(loc, record):
+        for line in record.get('ORTHOLOGY', list()):
+            rxn2kos[get_entry_id(record)].add(line.split()[0])
+    return rxn2kos, add_record
 
-    return rxn2kos
 
-
-def get_rxn_names():
-    """"""
-    f = open(DATABASE_DIR+REACTION_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
+def rxn_names_builder():
     rxn_names = dict()
-    for entry in f:
-        i = 0
-        entry = entry.strip().split('\n')
-        name = ""
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                r = line.strip().split()[0]
-                name = r
-            i += 1
 
-        if len(r) != 6 and r.startswith('R') is False:
-            print(r)
-        rxn_names[r] = name
+    def add_record(loc, record):
+        rxn_names[get_entry_id(record)] = get_entry_id(record)
+    return rxn_names, add_record
 
-    return rxn_names
 
-
-def get_ko_names():
-    """"""
-    f = open(DATABASE_DIR+KO_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
+def ko_names_builder():
     ko_names = dict()
-    for entry in f:
-        i = 0
-        entry = entry.strip().split('\n')
-        ko = None
-        name = None
-        defin = None
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                ko = line.strip().split()[0]
-            if new_start == "NAME":
-                name = line.strip()
-            if new_start == "DEFINITION":
-                defin = " ".join(line.split()[:-1])
-            i += 1
 
+    def add_record(loc, record):
+        ko = get_entry_id(record)
+        name = record['NAME'][0] if 'NAME' in record else None
+        defin = " ".join(record['DEFINITION'][0].split()[:-1]) if 'DEFINITION' in record else None
         if name is None:
             name = defin
         elif defin is not None and name is not None:
             name = defin + " (" + name + ")"
         elif defin is None and name is None:
             name = ko
-
         ko_names[ko] = name
-
-    return ko_names
+    return ko_names, add_record
 
 
-def get_co_info():
-    """returns a named tuple with all avaliable compound data
-    nametuple fields: id, name, formula, mass
-    """
+def co_info_builder():
     co_names = dict()
-    compound = namedtuple('Compound', 'co, name, formula, mass, rxn, pathways')
-
-    f = open(DATABASE_DIR+COMPOUND_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    for entry in f:
-        i = 0
-        entry = entry.strip().split('\n')
-        co = None
-        name = None
-        formula = None
-        mass = None
-        pathways = None
+    # field names holding the formula and mass differ between the compound and glycan files
+    formula_fields = {COMPOUND_LOC: "FORMULA", GLYCAN_LOC: "COMPOSITION"}
 
-        start = ""
-        rxns = []
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                co = line.strip().split()[0]
-                start = new_start
-            elif new_start == "NAME":
-                name = line.strip().split(';')[0]
-                start = new_start
-            elif new_start == "FORMULA":
-                formula = line.strip()
-                start = new_start
-            elif new_start == "EXACT_MASS":
-                mass = line.strip()
-                start = new_start
-            elif new_start == "REACTION":
-                rxns = line.strip().split()
-                start = new_start
-            elif new_start == "PATHWAY":
-                pathway = line.split()[0]
-                pathways = [pathway[2:]]
-                start = new_start
-            elif new_start == "":
-                if start == "PATHWAY":
-                    pathway = line.split()[0]
-                    pathways.append(pathway[2:])
-                elif start == "REACTION":
-                    rxn = line.strip().split()
-                    rxns += rxn
-            else:
-                start = new_start
-            i += 1
-
-        co_names[co] = compound(co=co, name=name, formula=formula, mass=mass, rxn=rxns, pathways=pathways)
-
-    f = open(DATABASE_DIR+GLYCAN_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    for entry in f:
-        i = 0
-        entry = entry.strip().split('\n')
-        co = None
-        name = None
-        formula = None
+    def add_record(loc, record):
+        co = get_entry_id(record)
+        name = record['NAME'][0].split(';')[0] if 'NAME' in record else None
+        formula = record[formula_fields[loc]][0] if formula_fields[loc] in record else None
         mass = None
+        if loc == COMPOUND_LOC and 'EXACT_MASS' in record:
+            mass = record['EXACT_MASS'][0]
+        elif loc == GLYCAN_LOC and 'MASS' in record:
+            mass = record['MASS'][0].split()[0]
+        rxns = [rxn for line in record.get('REACTION', list()) for rxn in line.split()]
         pathways = None
+        if 'PATHWAY' in record:
+            pathways = [line.split()[0][2:] for line in record['PATHWAY']]
+        co_names[co] = Compound(co=co, name=name, formula=formula, mass=mass, rxn=rxns, pathways=pathways)
+    return co_names, add_record
 
-        start = ""
-        rxns = []
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                co = line.strip().split()[0]
-                start = new_start
-            elif new_start == "NAME":
-                name = line.strip().split(';')[0]
-                start = new_start
-            elif new_start == "COMPOSITION":
-                formula = line.strip()
-                start = new_start
-            elif new_start == "MASS":
-                mass = line.strip().split()[0]
-                start = new_start
-            elif new_start == "REACTION":
-                rxns = line.strip().split()
-                start = new_start
-            elif new_start == "PATHWAY":
-                pathway = line.split()[0]
-                pathways = [pathway[2:]]
-                start = new_start
-            elif new_start == "":
-                if start == "PATHWAY":
-                    pathway = line.split()[0]
-                    pathways.append(pathway[2:])
-                elif start == "REACTION":
-                    rxn = line.strip().split()
-                    rxns += rxn
-            else:
-                start = new_start
-            i += 1
 
-        co_names[co] = compound(co=co, name=name, formula=formula, mass=mass, rxn=rxns, pathways=pathways)
+def pathway2cos_builder():
+    pathway2cos = defaultdict(list)
 
-    return co_names
+    def add_record(loc, record):
+        for line in record.get('PATHWAY', list()):
+            pathway2cos[line.split()[0][-5:]].append(get_entry_id(record))
+    return pathway2cos, add_record
 
 
-def get_pathway2cos():
-    """make a dictionary with pathways as keys and compound lists as values"""
-    pathway2cos = defaultdict(list)
+def pathway_names_builder():
+    pathway_names = dict()
 
-    f = open(DATABASE_DIR+COMPOUND_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                co = line.strip().split()[0]
-                if co == '':
-                    continue
-                start = new_start
-            elif new_start == "PATHWAY":
-                pathway = line.split()[0]
-                pathway2cos[pathway[-5:]].append(co)
-                start = new_start
-            elif new_start == "":
-                if start == "PATHWAY":
-                    pathway = line.split()[0]
-                    pathway2cos[pathway[-5:]].append(co)
-            else:
-                start = new_start
-            i += 1
-
-    f = open(DATABASE_DIR+GLYCAN_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "ENTRY":
-                co = line.strip().split()[0]
-                if co == '':
-                    continue
-                start = new_start
-            elif new_start == "PATHWAY":
-                pathway = line.split()[0]
-                pathway2cos[pathway[-5:]].append(co)
-                start = new_start
-            elif new_start == "":
-                if start == "PATHWAY":
-                    pathway = line.split()[0]
-                    pathway2cos[pathway[-5:]].append(co)
-            else:
-                start = new_start
-            i += 1
+    def add_record(loc, record):
+        for line in record.get('PATHWAY', list()):
+            pathway_names[line.split()[0][-5:]] = " ".join(line.split()[1:])
+    return pathway_names, add_record
 
-    return pathway2cos
 
+def co_counts_builder():
+    co_counts = Counter()
 
-def get_pathway_names():
-    """make a dictionary with pathways as keys and pathway names as values"""
-    pathway_names = dict()
+    def add_record(loc, record):
+        if 'EQUATION' in record:
+            reacts, prods, _ = parse_equation(record['EQUATION'][0])
+            co_counts.update(reacts)
+            co_counts.update(prods)
+    return co_counts, add_record
 
-    f = open(DATABASE_DIR+COMPOUND_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "PATHWAY":
-                pathway = line.split()[0]
-                pathway_names[pathway[-5:]] = (" ").join(line.split()[1:])
-                start = new_start
-            elif new_start == "":
-                if start == "PATHWAY":
-                    pathway = line.split()[0]
-                    pathway_names[pathway[-5:]] = (" ").join(line.split()[1:])
-            else:
-                start = new_start
-            i += 1
-
-    f = open(DATABASE_DIR+GLYCAN_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    for entry in f:
-        i = 0
-        start = ""
-        entry = entry.strip().split('\n')
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "PATHWAY":
-                pathway = line.split()[0]
-                pathway_names[pathway[-5:]] = (" ").join(line.split()[1:])
-                start = new_start
-            elif new_start == "":
-                if start == "PATHWAY":
-                    pathway = line.split()[0]
-                    pathway_names[pathway[-5:]] = (" ").join(line.split()[1:])
-            else:
-                start = new_start
-            i += 1
 
-    return pathway_names
+def get_reactions():
+    """get compounds for each reaction and each KO"""
+    return build_maps([get_reactions])[get_reactions]
+
+
+def get_ko2rxns():
+    return build_maps([get_ko2rxns])[get_ko2rxns]
+
+
+def get_class2kos():
+    return build_maps([get_class2kos])[get_class2kos]
+
+
+def get_pathway2kos():
+    return build_maps([get_pathway2kos])[get_pathway2kos]
+
+
+def get_pathway2rxns():
+    return build_maps([get_pathway2rxns])[get_pathway2rxns]
+
+
+def get_rxn2kos():
+    """"""
+    return build_maps([get_rxn2kos])[get_rxn2kos]
+
+
+def get_rxn_names():
+    """"""
+    return build_maps([get_rxn_names])[get_rxn_names]
+
+
+def get_ko_names():
+    """"""
+    return build_maps([get_ko_names])[get_ko_names]
+
+
+def get_co_info():
+    """returns a named tuple with all avaliable compound data
+    nametuple fields: id, name, formula, mass
+    """
+    return build_maps([get_co_info])[get_co_info]
+
+
+def get_pathway2cos():
+    """make a dictionary with pathways as keys and compound lists as values"""
+    return build_maps([get_pathway2cos])[get_pathway2cos]
+
+
+def get_pathway_names():
+    """make a dictionary with pathways as keys and pathway names as values"""
+    return build_maps([get_pathway_names])[get_pathway_names]
 
 
 def get_co_counts():
     """get compounds for each reaction and each KO
 
     """
-    f = open(DATABASE_DIR+REACTION_LOC, 'U')
-    f = f.read()
-    f = f.strip().split('///')
-    co_counts = Counter()
-    for entry in f:
-        i = 0
-        entry = entry.strip().split('\n')
-
-        while i < len(entry):
-            new_start = entry[i][:12].strip()
-            line = entry[i][12:].strip()
-
-            if new_start == "EQUATION":
-                equ = line.split('=>')
-                if equ[0][-1] == '<':
-                    equ[0] = equ[0][:-1]
-                for part in equ[0].strip().split():
-                    if part[0] == 'C' or part[0] == 'G':
-                        co_counts[part[:6]] += 1
-                for part in equ[1].strip().split():
-                    if part[0] == 'C' or part[0] == 'G':
-                        co_counts[part[:6]] += 1
-            i += 1
-    return co_counts
+    return build_maps([get_co_counts])[get_co_counts]
 
 
 def get_reaction_mapformula_cos():
     """Creates a CO set from compounds present in reaction_mapformula.lst file.
     """
-    f = open(DATABASE_DIR+REACTION_MAPFORMULA_LOC, 'U')
     cos = set()
-    for line in f:
-        line = line.strip().split()[2:]
-        for part in line:
-            if len(part) == 6 and part.startswith("C"):
-                cos.add(part)
+    with open(DATABASE_DIR+REACTION_MAPFORMULA_LOC) as f:
+        for line in f:
+            line = line.strip().split()[2:]
+            for part in line:
+                if len(part) == 6 and part.startswith("C"):
+                    cos.add(part)
     return cos
 
 
 def parse_reaction_mapformula():
     """adapted from parse_formula() from run_metabolic_networks_old.py
     """
-    f = open(DATABASE_DIR+REACTION_MAPFORMULA_LOC, 'U')
+    f = open(DATABASE_DIR+REACTION_MAPFORMULA_LOC)
     rxns = dict()
     for line in f:
         # from parse_mapformula_file from parse_kegg.py
@@ -732,3 +464,144 @@ def get_human_genome():
         if "ORTHOLOGY" in line:
             human_kos.append(line.strip().split()[1])
     return human_kos
+
+
+CACHED_SOURCES = {
+    get_reactions: [REACTION_LOC],
+    get_ko2rxns: [KO_LOC],
+    get_class2kos: [KO_LOC],
+    get_pathway2kos: [KO_LOC],
+    get_pathway2rxns: [REACTION_LOC],
+    get_rxn2kos: [REACTION_LOC],
+    get_rxn_names: [REACTION_LOC],
+    get_ko_names: [KO_LOC],
+    get_co_info: [COMPOUND_LOC, GLYCAN_LOC],
+    get_pathway2cos: [COMPOUND_LOC, GLYCAN_LOC],
+    get_pathway_names: [COMPOUND_LOC, GLYCAN_LOC],
+    get_co_counts: [REACTION_LOC],
+    get_reaction_mapformula_cos: [REACTION_MAPFORMULA_LOC],
+    parse_reaction_mapformula: [REACTION_MAPFORMULA_LOC],
+    get_human_genome: [HUMAN_GENOME_LOC],
+}
+
+# getters that are built from '///' separated entries by build_maps
+RECORD_BUILDERS = {
+    get_reactions: reactions_builder,
+    get_ko2rxns: ko2rxns_builder,
+    get_class2kos: class2kos_builder,
+    get_pathway2kos: pathway2ids_builder,
+    get_pathway2rxns: pathway2ids_builder,
+    get_rxn2kos: rxn2kos_builder,
+    get_rxn_names: rxn_names_builder,
+    get_ko_names: ko_names_builder,
+    get_co_info: co_info_builder,
+    get_pathway2cos: pathway2cos_builder,
+    get_pathway_names: pathway_names_builder,
+    get_co_counts: co_counts_builder,
+}
+
+
+def get_cache_dir():
+    if CACHE_DIR is not None:
+        return CACHE_DIR
+    return os.path.join(DATABASE_DIR, "pickles")
+
+
+def get_cache_key(getter):
+    """cache version plus path, mtime and size of every KEGG file getter parses"""
+    key = [CACHE_VERSION]
+    for loc in CACHED_SOURCES[getter]:
+        stat = os.stat(DATABASE_DIR+loc)
+        key.append((os.path.abspath(DATABASE_DIR+loc), stat.st_mtime_ns, stat.st_size))
+    return key
+
+
+def get_content_hash(getter):
+    """sha1 of the contents of every KEGG file getter parses, which unlike get_cache_key does not change when the
+    files are touched, copied or moved"""
+    sha1 = hashlib.sha1()
+    for loc in CACHED_SOURCES[getter]:
+        with open(DATABASE_DIR+loc, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_cache_loc(getter):
+    return os.path.join(get_cache_dir(), getter.__name__ + ".pkl")
+
+
+def read_cache(getter, key):
+    """map from getter's pickle snapshot, or None if there is no snapshot matching key"""
+    try:
+        with open(get_cache_loc(getter), 'rb') as f:
+            if pickle.load(f) == key:
+                return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        pass
+    return None
+
+
+def write_cache(getter, key, data):
+    try:
+        os.makedirs(get_cache_dir(), exist_ok=True)
+        # write then rename so concurrent workers never read a partial snapshot
+        tmp_loc = "%s.%s.tmp" % (get_cache_loc(getter), os.getpid())
+        with open(tmp_loc, 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_loc, get_cache_loc(getter))
+    except (IOError, OSError):
+        warnings.warn("Unable to write KEGG cache to %s" % get_cache_dir())
+
+
+def load_cached_maps(getters, rebuild=False):
+    """Returns a dictionary of getter to getter() loaded from pickle snapshots in the cache directory.  Snapshots
+    that are missing, were written by a different CACHE_VERSION or whose KEGG files have changed are rebuilt
+    together with build_maps, so each KEGG file is parsed at most once.
+    """
+    keys = {getter: get_cache_key(getter) for getter in getters}
+    maps = dict()
+    if not rebuild:
+        for getter in getters:
+            data = read_cache(getter, keys[getter])
+            if data is not None:
+                maps[getter] = data
+    stale = [getter for getter in getters if getter not in maps]
+    if len(stale) > 0:
+        for getter, data in build_maps(stale).items():
+            write_cache(getter, keys[getter], data)
+            maps[getter] = data
+    return maps
+
+
+def load_cached(getter, rebuild=False):
+    """Returns getter() from its pickle snapshot, see load_cached_maps"""
+    return load_cached_maps([getter], rebuild)[getter]
+
+
+def main():
+    global DATABASE_DIR, CACHE_DIR
+    getters = {getter.__name__: getter for getter in CACHED_SOURCES}
+    parser = argparse.ArgumentParser(description="Prebuild pickle snapshots of parsed KEGG files",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--database_dir", help="location of kegg database", default=DATABASE_DIR)
+    parser.add_argument("--cache_dir", help="location to write snapshots, defaults to database_dir/pickles")
+    parser.add_argument("--maps", help="maps to build, defaults to all with their source files present", nargs='+',
+                        choices=sorted(getters))
+    parser.add_argument("--rebuild", help="rebuild snapshots even if up to date", action='store_true')
+    args = parser.parse_args()
+
+    DATABASE_DIR = args.database_dir
+    CACHE_DIR = args.cache_dir
+    if args.maps is None:
+        maps = [name for name, getter in sorted(getters.items())
+                if all(os.path.exists(DATABASE_DIR+loc) for loc in CACHED_SOURCES[getter])]
+    else:
+        maps = args.maps
+    load_cached_maps([getters[name] for name in maps], args.rebuild)
+    print('\n'.join(maps))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,22 @@ from os import path
 from biom.table import Table
 import numpy as np
 from io import StringIO
+from itertools import islice
+from scipy import sparse
+import argparse
 import gzip
+import os
+import pickle
+import warnings
 """Functions stolen from picrust, adapted to python 3 and then adapted for my usage"""
 
+INDEX_VERSION = 3
+index_batch_size = 1000
+precalc_block_size = 1000
+indexed_table = None
+# directory with the precalculated table and greengenes files, the data directory beside this file if not set
+DATA_DIR = None
+
 
 def load_data_table(ids_to_load):
     """Stolen from https://github.com/picrust/picrust/blob/master/scripts/predict_metagenomes.py
@@ -18,23 +31,166 @@ def load_data_table(ids_to_load):
     ids_to_load -- a list of OTU ids for which data should be loaded
     gzipped files are detected based on the '.gz' suffix.
     """
-    # first two lines adapted from determine_data_table_fp from
-    # https://github.com/picrust/picrust/blob/master/scripts/predict_metagenomes.py
-    # stolen setup from predict_metagenomes.py from PICRUSt
-    precalc_file_name = '_'.join(["ko", "13_5", 'precalculated.tab.gz'])
-    data_table_fp = path.join(get_data_dir(), precalc_file_name)
-
+    data_table_fp = get_precalc_fp()
     if not path.exists(data_table_fp):
         raise IOError("File " + data_table_fp + " doesn't exist! Did you forget to download it?")
 
+    if get_indexed_table(data_table_fp) is not None:
+        return load_indexed_table(ids_to_load, data_table_fp)
+
     genome_table_fh = gzip.open(data_table_fp, 'rt')
     genome_table = convert_precalc_to_biom(genome_table_fh, ids_to_load)
     return genome_table
 
 
+def get_precalc_fp():
+    # adapted from determine_data_table_fp from
+    # https://github.com/picrust/picrust/blob/master/scripts/predict_metagenomes.py
+    # stolen setup from predict_metagenomes.py from PICRUSt
+    precalc_file_name = '_'.join(["ko", "13_5", 'precalculated.tab.gz'])
+    return path.join(get_data_dir(), precalc_file_name)
+
+
+def get_index_fps(data_table_fp):
+    """locations of the row index and the directory of memory mappable CSR arrays made from a precalculated table"""
+    prefix = data_table_fp[:-len('.tab.gz')] if data_table_fp.endswith('.tab.gz') else data_table_fp
+    return prefix + '.index.pkl', prefix + '.csr'
+
+
+def index_precalc_table(data_table_fp, md_prefix='metadata_'):
+    """Convert a gzipped PICRUSt precalculated table to CSR arrays on disk that can be memory mapped, OTUs as rows,
+    data as uint16 if every value is a small whole number, float32 otherwise, and column indices as uint16 when there
+    are few enough traits, plus a pickled index of OTU id to
+    row, trait ids and metadata.  Only the nonzero counts are kept, most OTUs carrying a small fraction of the KOs,
+    and only one block of rows is held in memory at a time.
+    """
+    index_fp, matrix_fp = get_index_fps(data_table_fp)
+    source = get_source_stamp(data_table_fp)
+    os.makedirs(matrix_fp, exist_ok=True)
+    fh = gzip.open(data_table_fp, 'rt')
+    trait_ids, col_meta_locs, end_of_data = read_precalc_header(fh, md_prefix)
+    row_meta = [{} for i in trait_ids]
+
+    otu_ids = []
+    col_meta = []
+    indptr = [np.zeros(1, dtype=np.int64)]
+    fits_uint16 = True
+    indices_tmp = os.path.join(matrix_fp, 'indices.tmp')
+    data_tmp = os.path.join(matrix_fp, 'data.tmp')
+    with open(indices_tmp, 'wb') as indices_out, open(data_tmp, 'wb') as data_out:
+        for block_ids, block_meta, block in iter_precalc_blocks(fh, trait_ids, col_meta_locs, end_of_data, row_meta,
+                                                                md_prefix, index_batch_size):
+            block.eliminate_zeros()
+            block.sort_indices()
+            otu_ids.extend(block_ids)
+            col_meta.extend(block_meta)
+            indptr.append(block.indptr[1:].astype(np.int64) + indptr[-1][-1])
+            indices_out.write(block.indices.astype(np.int32).tobytes())
+            data = block.data.astype(np.float32)
+            data_out.write(data.tobytes())
+            # precalculated counts are whole numbers so they usually fit in half the space
+            if data.size > 0 and (data.min() < 0 or data.max() > np.iinfo(np.uint16).max or
+                                  not np.array_equal(data, np.round(data))):
+                fits_uint16 = False
+    fh.close()
+
+    indptr = np.concatenate(indptr)
+    dtype = np.uint16 if fits_uint16 else np.float32
+    indices_dtype = np.uint16 if len(trait_ids) <= np.iinfo(np.uint16).max + 1 else np.int32
+    np.save(os.path.join(matrix_fp, 'indptr.npy'), indptr)
+    for name, tmp, in_dtype, out_dtype in (('indices', indices_tmp, np.int32, indices_dtype),
+                                           ('data', data_tmp, np.float32, dtype)):
+        tmp_values = np.memmap(tmp, dtype=in_dtype, mode='r', shape=(int(indptr[-1]),)) if indptr[-1] > 0 else \
+            np.zeros(0, dtype=in_dtype)
+        out = np.lib.format.open_memmap(os.path.join(matrix_fp, name + '.npy'), mode='w+', dtype=out_dtype,
+                                        shape=(int(indptr[-1]),))
+        for i in range(0, len(out), index_batch_size * 1000):
+            out[i:i+index_batch_size*1000] = tmp_values[i:i+index_batch_size*1000]
+        out.flush()
+        del out, tmp_values
+        os.remove(tmp)
+
+    shape = (len(otu_ids), len(trait_ids))
+    index = {'version': INDEX_VERSION, 'source': source, 'dtype': np.dtype(dtype).str, 'shape': shape,
+             'otu_index': {otu_id: i for i, otu_id in enumerate(otu_ids)}, 'trait_ids': trait_ids,
+             'row_meta': row_meta, 'col_meta': col_meta}
+    with open(index_fp, 'wb') as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    return index_fp, matrix_fp
+
+
+def get_source_stamp(data_table_fp):
+    """size and modification time of a precalculated table, kept in its index to tell when the table is replaced"""
+    stat = os.stat(data_table_fp)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def get_indexed_table(data_table_fp):
+    """index and read only memory mapped (data, indices, indptr) CSR arrays of an indexed precalculated table, opened
+    once per process so forked workers share the same pages.  None if the table has no index or has changed since it
+    was indexed, then the table itself has to be read."""
+    global indexed_table
+    index_fp, matrix_fp = get_index_fps(data_table_fp)
+    if not path.exists(index_fp):
+        return None
+    # a rebuilt index is picked up as well as a replaced table
+    key = data_table_fp, get_source_stamp(data_table_fp), os.stat(index_fp).st_mtime_ns
+    if indexed_table is None or indexed_table[0] != key:
+        with open(index_fp, 'rb') as f:
+            index = pickle.load(f)
+        if index['version'] != INDEX_VERSION:
+            raise ValueError("Index %s is out of date, rebuild it with index_precalc_table" % index_fp)
+        if tuple(index['source']) != key[1]:
+            warnings.warn("%s changed since it was indexed, reading it without the index until it is rebuilt with "
+                          "index_precalc_table" % data_table_fp)
+            indexed_table = key, None
+        else:
+            matrix = tuple([np.load(os.path.join(matrix_fp, name + '.npy'), mmap_mode='r')
+                            for name in ('data', 'indices', 'indptr')])
+            indexed_table = key, (index, matrix)
+    return indexed_table[1]
+
+
+def load_indexed_table(ids_to_load, data_table_fp):
+    """Build the same BIOM table as convert_precalc_to_biom by slicing the requested rows out of the memory mapped
+    CSR matrix made by index_precalc_table"""
+    indexed = get_indexed_table(data_table_fp)
+    if indexed is None:
+        raise ValueError("%s has no index matching it, build one with index_precalc_table" % data_table_fp)
+    index, matrix = indexed
+    otu_index = index['otu_index']
+    if ids_to_load is None or len(ids_to_load) == 0:
+        otu_ids = sorted(otu_index, key=otu_index.get)
+    else:
+        otu_ids = list(dict.fromkeys(ids_to_load))
+        missing = [i for i in otu_ids if i not in otu_index]
+        if len(missing) == len(otu_ids):
+            raise ValueError("No OTUs match identifiers in precalculated file. PICRUSt requires an OTU table reference/closed picked against GreenGenes.\nExample of the first 5 OTU ids from your table: {0}".format(', '.join(missing[:5])))
+        if missing:
+            raise ValueError("One or more OTU ids were not found in the precalculated file!\nAre you using the correct --gg_version?\nExample of (the {0}) unknown OTU ids: {1}".format(len(missing), ', '.join(missing[:5])))
+    rows = np.array([otu_index[i] for i in otu_ids], dtype=np.int64)
+    matching = get_csr_rows(matrix, rows, len(index['trait_ids']))
+    col_meta = [index['col_meta'][i] for i in rows]
+    return Table(matching.T.tocsr(), index['trait_ids'], otu_ids, index['row_meta'], col_meta, type='Gene table')
+
+
+def get_csr_rows(matrix, rows, n_cols):
+    """rows of (data, indices, indptr) CSR arrays as a float64 csr_matrix, reading only those rows of mapped arrays"""
+    data, indices, indptr = matrix
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    row_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    row_indptr[1:] = np.cumsum(lengths)
+    take = np.repeat(starts - row_indptr[:-1], lengths) + np.arange(row_indptr[-1])
+    return sparse.csr_matrix((data[take].astype(np.float64), indices[take].astype(np.int32), row_indptr),
+                             shape=(len(rows), n_cols))
+
+
 def get_data_dir():
     """ Returns the top-level PICRUST directory
     """
+    if DATA_DIR is not None:
+        return DATA_DIR
     # Get the full path of util.py
     current_file_path = path.abspath(__file__)
     # Get the directory containing util.py
@@ -43,6 +199,11 @@ def get_data_dir():
     return path.join(current_dir_path, 'data')
 
 
+def get_tree_loc():
+    """Returns the location of the greengenes 99% OTU tree in the data directory"""
+    return path.join(get_data_dir(), 'gg_13_8_otus', 'trees', '99_otus.tree')
+
+
 def determine_metadata_type(line):
     if ';' in line:
         if '|' in line:
@@ -62,16 +223,17 @@ def parse_metadata_field(metadata_str,metadata_format='string'):
         return [[e.strip() for e in y.split(';')] for y in metadata_str.split('|')]
 
 
-def convert_precalc_to_biom(precalc_in, ids_to_load=None,transpose=True,md_prefix='metadata_'):
-    """Loads PICRUSTs tab-delimited version of the precalc file and outputs a BIOM object"""
+def parse_precalc_rows(lines, end_of_data):
+    """counts of a block of precalculated table lines as a sparse matrix, parsed by numpy in one call"""
+    if len(lines) == 0:
+        return sparse.csr_matrix((0, end_of_data - 1))
+    counts = np.loadtxt(lines, dtype=np.float64, delimiter='\t', usecols=range(1, end_of_data), ndmin=2,
+                        comments=None)
+    return sparse.csr_matrix(counts)
 
-    #if given a string convert to a filehandle
-    if type(precalc_in) == str:
-        fh = StringIO(precalc_in)
-    else:
-        fh=precalc_in
 
-    #first line has to be header
+def read_precalc_header(fh, md_prefix='metadata_'):
+    """trait ids, position of each metadata column and where the counts end from the header line"""
     header_ids=fh.readline().strip().split('\t')
 
     col_meta_locs={}
@@ -81,53 +243,112 @@ def convert_precalc_to_biom(precalc_in, ids_to_load=None,transpose=True,md_prefi
 
     end_of_data=len(header_ids)-len(col_meta_locs)
     trait_ids = header_ids[1:end_of_data]
+    return trait_ids, col_meta_locs, end_of_data
+
+
+def iter_precalc_blocks(fh, trait_ids, col_meta_locs, end_of_data, row_meta, md_prefix='metadata_',
+                        block_size=precalc_block_size, ids_to_load=None):
+    """Read the lines after the header block_size at a time
+
+    Rows are picked by their id before anything else is parsed.  Metadata rows are added to row_meta, and if
+    ids_to_load is a set only rows with ids in it are kept, each removed from it when first seen.
+
+    Yields
+    ------
+    otu_ids, col_meta, counts: ids, metadata and a sparse matrix of the counts of the rows kept from each block
+    """
+    while True:
+        lines = list(islice(fh, block_size))
+        if len(lines) == 0:
+            break
+        otu_ids = []
+        col_meta = []
+        picked = []
+        for line in lines:
+            row_id = line[:line.find('\t')]
+            if row_id.startswith(md_prefix):
+                #handle metadata
+                fields = line.strip().split('\t')
+
+                #determine type of metadata (this may not be perfect)
+                metadata_type=determine_metadata_type(line)
+                for idx,trait_name in enumerate(trait_ids):
+                    row_meta[idx][row_id[len(md_prefix):]]=parse_metadata_field(fields[idx+1],metadata_type)
+
+            elif ids_to_load is None or row_id in ids_to_load:
+                otu_ids.append(row_id)
+                picked.append(line)
+
+                #add metadata
+                if len(col_meta_locs) > 0:
+                    fields = line.strip().split('\t')
+                    col_meta.append({meta_name: fields[loc] for meta_name, loc in col_meta_locs.items()})
+                else:
+                    col_meta.append({})
+
+                if ids_to_load is not None:
+                    ids_to_load.remove(row_id)
+        yield otu_ids, col_meta, parse_precalc_rows(picked, end_of_data)
+
+
+def convert_precalc_to_biom(precalc_in, ids_to_load=None,transpose=True,md_prefix='metadata_',
+                            block_size=precalc_block_size):
+    """Loads PICRUSTs tab-delimited version of the precalc file and outputs a BIOM object
+
+    Lines are read block_size at a time, rows are picked by their id before anything else is parsed and the counts
+    of the picked rows are parsed a block at a time into sparse matrices, so memory grows with the rows loaded
+    rather than the size of the file.
+    """
+
+    #if given a string convert to a filehandle
+    if type(precalc_in) == str:
+        fh = StringIO(precalc_in)
+    else:
+        fh=precalc_in
+
+    #first line has to be header
+    trait_ids, col_meta_locs, end_of_data = read_precalc_header(fh, md_prefix)
 
     col_meta=[]
     row_meta=[{} for i in trait_ids]
 
     if ids_to_load is not None and len(ids_to_load) > 0:
+        # ids still to find, each row is only loaded the first time its id is seen
         ids_to_load=set(ids_to_load)
-        load_all_ids=False
     else:
-        load_all_ids=True
+        ids_to_load=None
 
-    matching=[]
+    blocks=[]
     otu_ids=[]
-    for line in fh:
-        fields = line.strip().split('\t')
-        row_id=fields[0]
-        if(row_id.startswith(md_prefix)):
-            #handle metadata
-
-            #determine type of metadata (this may not be perfect)
-            metadata_type=determine_metadata_type(line)
-            for idx,trait_name in enumerate(trait_ids):
-                row_meta[idx][row_id[len(md_prefix):]]=parse_metadata_field(fields[idx+1],metadata_type)
-
-        elif load_all_ids or (row_id in set(ids_to_load)):
-            otu_ids.append(row_id)
-            matching.append(list(map(float,fields[1:end_of_data])))
-
-            #add metadata
-            col_meta_dict={}
-            for meta_name in col_meta_locs:
-                col_meta_dict[meta_name]=fields[col_meta_locs[meta_name]]
-            col_meta.append(col_meta_dict)
-
-            if not load_all_ids:
-                ids_to_load.remove(row_id)
+    for block_ids, block_meta, block in iter_precalc_blocks(fh, trait_ids, col_meta_locs, end_of_data, row_meta,
+                                                            md_prefix, block_size, ids_to_load):
+        otu_ids.extend(block_ids)
+        col_meta.extend(block_meta)
+        blocks.append(block)
 
     if not otu_ids:
-        raise ValueError("No OTUs match identifiers in precalculated file. PICRUSt requires an OTU table reference/closed picked against GreenGenes.\nExample of the first 5 OTU ids from your table: {0}".format(', '.join(list(ids_to_load)[:5])))
+        raise ValueError("No OTUs match identifiers in precalculated file. PICRUSt requires an OTU table reference/closed picked against GreenGenes.\nExample of the first 5 OTU ids from your table: {0}".format(', '.join(list(ids_to_load or [])[:5])))
 
     if ids_to_load:
        raise ValueError("One or more OTU ids were not found in the precalculated file!\nAre you using the correct --gg_version?\nExample of (the {0}) unknown OTU ids: {1}".format(len(ids_to_load),', '.join(list(ids_to_load)[:5])))
 
     #note that we transpose the data before making biom obj
-    matching = np.asarray(matching)
+    matching = sparse.vstack(blocks, format='csr')
     if transpose:
-        return Table(matching.T, trait_ids, otu_ids, row_meta, col_meta,
+        return Table(matching.T.tocsr(), trait_ids, otu_ids, row_meta, col_meta,
                      type='Gene table')
     else:
         return Table(matching, otu_ids, trait_ids, col_meta, row_meta,
                      type='Gene table')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index a PICRUSt precalculated table for memory mapped loading",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--precalc_loc", help="gzipped precalculated table", default=get_precalc_fp())
+    args = parser.parse_args()
+    print('\n'.join(index_precalc_table(args.precalc_loc)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""seed_detection.py
+Seed sets of metabolic networks computed on integer CSR adjacency arrays.  The seeds of a network are the nodes of
+its source strongly connected components, the components no edge enters from outside, which is what
+mna.determine_seed_set finds with networkx.  Here the components come from one call to
+scipy.sparse.csgraph.connected_components (an iterative Pearce/Tarjan pass in compiled code), and the source
+components from the in-degree of the condensation, found in one sweep over the edges whose ends lie in different
+components.
+
+Seed groups are returned as an array giving the seed group of every node, or NOT_SEED, the layout
+CompactGraph.seed_groups stores.  Groups are numbered in order of their lowest node position, so nodes sorted by
+compound code give groups in compound code order.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+NOT_SEED = -1
+
+
+def _adjacency(n_nodes, indptr, indices):
+    data = np.ones(len(indices), dtype=np.int8)
+    return sparse.csr_matrix((data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int32)),
+                             shape=(n_nodes, n_nodes))
+
+
+def _seed_groups_from_labels(labels, n_components, sources, targets, groups=None):
+    """seed group of each node from strong component labels, numbering groups within each of groups, an array
+    of the part of a larger graph each node belongs to, separately"""
+    n_nodes = len(labels)
+    # a component is a source if no edge between two different components points into it
+    crossing = labels[sources] != labels[targets]
+    has_in_edge = np.zeros(n_components, dtype=bool)
+    has_in_edge[labels[targets[crossing]]] = True
+
+    first_node = np.full(n_components, n_nodes, dtype=np.int64)
+    np.minimum.at(first_node, labels, np.arange(n_nodes))
+    seed_components = np.flatnonzero(~has_in_edge)
+    seed_components = seed_components[np.argsort(first_node[seed_components], kind='stable')]
+
+    group_of_component = np.full(n_components, NOT_SEED, dtype=np.int64)
+    if groups is None:
+        group_of_component[seed_components] = np.arange(len(seed_components))
+    else:
+        # restart numbering at 0 for each part, parts being in node order
+        part = groups[first_node[seed_components]]
+        starts = np.searchsorted(part, part, side='left')
+        group_of_component[seed_components] = np.arange(len(seed_components)) - starts
+    return group_of_component[labels].astype(np.int32)
+
+
+def find_seed_groups(n_nodes, indptr, indices):
+    """seed group of each node of a graph given as CSR arrays, NOT_SEED for nodes that are not seeds"""
+    if n_nodes == 0:
+        return np.zeros(0, dtype=np.int32)
+    n_components, labels = connected_components(_adjacency(n_nodes, indptr, indices), directed=True,
+                                                connection='strong')
+    sources = np.repeat(np.arange(n_nodes), np.diff(np.asarray(indptr, dtype=np.int64)))
+    return _seed_groups_from_labels(labels, n_components, sources, np.asarray(indices, dtype=np.int64))
+
+
+def find_seed_groups_batch(graphs):
+    """Seed groups of many graphs at once
+
+    Parameters
+    ----------
+    graphs: list of (n_nodes, indptr, indices) CSR graphs
+
+    Returns
+    -------
+    list of seed group arrays, one per graph, numbered as find_seed_groups numbers them
+
+    The graphs are stacked into one block diagonal adjacency matrix, so their components are found with one
+    connected_components call however many graphs there are.
+    """
+    if len(graphs) == 0:
+        return list()
+    sizes = np.array([n_nodes for n_nodes, _, _ in graphs], dtype=np.int64)
+    node_offsets = np.zeros(len(graphs) + 1, dtype=np.int64)
+    node_offsets[1:] = np.cumsum(sizes)
+    edge_counts = [len(indices) for _, _, indices in graphs]
+    edge_offsets = np.zeros(len(graphs) + 1, dtype=np.int64)
+    edge_offsets[1:] = np.cumsum(edge_counts)
+
+    indptr = np.concatenate([[0]] + [np.asarray(graph_indptr[1:], dtype=np.int64) + edge_offset
+                                     for (_, graph_indptr, _), edge_offset in zip(graphs, edge_offsets)])
+    indices = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                             [np.asarray(graph_indices, dtype=np.int64) + node_offset
+                              for (_, _, graph_indices), node_offset in zip(graphs, node_offsets)])
+    n_nodes = int(node_offsets[-1])
+    if n_nodes == 0:
+        return [np.zeros(0, dtype=np.int32) for _ in graphs]
+    n_components, labels = connected_components(_adjacency(n_nodes, indptr, indices), directed=True,
+                                                connection='strong')
+    sources = np.repeat(np.arange(n_nodes), np.diff(indptr))
+    parts = np.repeat(np.arange(len(graphs)), sizes)
+    seed_groups = _seed_groups_from_labels(labels, n_components, sources, indices, parts)
+    return [seed_groups[node_offsets[i]:node_offsets[i+1]] for i in range(len(graphs))]
+
+
+def seed_sets_from_groups(seed_groups, nodes):
+    """seed groups as the {group: [node, ...]} dictionary mna.determine_seed_set returns"""
+    seed_sets = dict()
+    for i in np.flatnonzero(seed_groups != NOT_SEED):
+        seed_sets.setdefault(int(seed_groups[i]), list()).append(nodes[i])
+    return {i: seed_sets[i] for i in sorted(seed_sets)}
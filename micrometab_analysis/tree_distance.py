@@ -0,0 +1,108 @@
+"""tree_distance.py
+Tip to tip distances on a large phylogenetic tree.  The tree is flattened once into numpy arrays (parent, depth
+and distance to root for every node in preorder) and a sparse table is built over the preorder so the lowest
+common ancestor of any two tips is found with two lookups.  Distances are then
+root_dist[a] + root_dist[b] - 2*root_dist[lca].
+"""
+
+import numpy as np
+
+
+class TreeDistance:
+    """class to answer tip to tip distance queries on a tree parsed once"""
+    def __init__(self, tree):
+        names = list()
+        parents = list()
+        levels = list()
+        root_dists = list()
+
+        # iterative preorder so the greengenes tree does not hit the recursion limit
+        stack = [(tree, -1)]
+        while len(stack) > 0:
+            node, parent = stack.pop()
+            index = len(names)
+            names.append(node.name)
+            parents.append(parent)
+            if parent == -1:
+                levels.append(0)
+                root_dists.append(0.)
+            else:
+                levels.append(levels[parent] + 1)
+                root_dists.append(root_dists[parent] + (node.length if node.length is not None else 0.))
+            for child in reversed(node.children):
+                stack.append((child, index))
+
+        self.parents = np.array(parents, dtype=np.int32)
+        self.levels = np.array(levels, dtype=np.int32)
+        self.root_dists = np.array(root_dists, dtype=np.float64)
+        internal = set(parents)
+        self.tip_index = {str(name): i for i, name in enumerate(names) if name is not None and i not in internal}
+        self.sparse_table = self._build_sparse_table(self.levels)
+
+    @classmethod
+    def read(cls, tree_loc):
+        from skbio import TreeNode
+        return cls(TreeNode.read(tree_loc))
+
+    @staticmethod
+    def _build_sparse_table(levels):
+        """sparse table of the index of the shallowest node in each power of two window of the preorder"""
+        table = [np.arange(len(levels), dtype=np.int32)]
+        width = 1
+        while width * 2 <= len(levels):
+            prev = table[-1]
+            left = prev[:len(prev) - width]
+            right = prev[width:]
+            table.append(np.where(levels[left] <= levels[right], left, right))
+            width *= 2
+        return table
+
+    def _lca(self, a, b):
+        """vectorized lowest common ancestor of preorder indices a and b"""
+        lo = np.minimum(a, b)
+        hi = np.maximum(a, b)
+        same = lo == hi
+        # shallowest node in (lo, hi] is a child of the lca, so its parent is the lca
+        start = np.where(same, lo, lo + 1)
+        span = hi - start + 1
+        k = np.floor(np.log2(span)).astype(np.int64)
+        lca = np.empty(len(lo), dtype=np.int64)
+        for level in np.unique(k):
+            mask = k == level
+            left = self.sparse_table[level][start[mask]]
+            right = self.sparse_table[level][hi[mask] - (1 << int(level)) + 1]
+            lca[mask] = np.where(self.levels[left] <= self.levels[right], left, right)
+        lca = np.where(same, lo, self.parents[lca])
+        return lca
+
+    def get_tip(self, tip):
+        try:
+            return self.tip_index[str(tip)]
+        except KeyError:
+            raise KeyError("Tip %s not in tree." % tip)
+
+    def distance(self, tip_a, tip_b):
+        """distance between two tips"""
+        return float(self.distances([(tip_a, tip_b)])[0])
+
+    def distances(self, pairs):
+        """distances for an iterable of (tip_a, tip_b) pairs, returned as a numpy array"""
+        pairs = list(pairs)
+        if len(pairs) == 0:
+            return np.zeros(0)
+        a = np.array([self.get_tip(i) for i, _ in pairs], dtype=np.int64)
+        b = np.array([self.get_tip(j) for _, j in pairs], dtype=np.int64)
+        return self._distances(a, b)
+
+    def _distances(self, a, b):
+        lca = self._lca(a, b)
+        return self.root_dists[a] + self.root_dists[b] - 2 * self.root_dists[lca]
+
+    def distance_matrix(self, tips):
+        """all pairs distance matrix for a list of tips, rows and columns in order of tips"""
+        index = np.array([self.get_tip(i) for i in tips], dtype=np.int64)
+        dists = np.zeros((len(index), len(index)))
+        rows, cols = np.triu_indices(len(index), k=1)
+        dists[rows, cols] = self._distances(index[rows], index[cols])
+        dists[cols, rows] = dists[rows, cols]
+        return dists
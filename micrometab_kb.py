@@ -1,25 +1,65 @@
 import json
+import sqlite3
+import zlib
 from os import path
-from itertools import zip_longest
+from tempfile import NamedTemporaryFile
+from threading import Lock
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
-from py2cytoscape import util as cy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, abort
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import joinedload, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm.exc import NoResultFound
-from skbio import TreeNode
 
-from database_setup import Genome, Base
-from micrometab_analysis import metabolic_network_analysis as mna
+import community_analysis as ca
+from database_setup import Genome, GenomeData, Base
+from genome_cache import GenomeCache, ProcessedGenome, MAX_GENOMES, MAX_MB
+from pair_results import PairResultStore, compute_pair_result
 from micrometab_analysis import picrust_util as pu
+from micrometab_analysis.compact_graph import CompactGraph
+from micrometab_analysis.ko_sets import kos_to_str
+from micrometab_analysis.tree_distance import TreeDistance
 
 app = Flask(__name__)
+app.config.setdefault('GENOME_CACHE_MAX_GENOMES', MAX_GENOMES)
+app.config.setdefault('GENOME_CACHE_MAX_MB', MAX_MB)
+# every pair is computed on request unless this names a pair results database, such as one filled ahead of time
+# with pair_results.py, to read pairs from and store them in
+app.config.setdefault('PAIR_RESULTS_LOC', None)
 
-engine = create_engine('sqlite:///gg_genomes.db')
+DB_LOC = "gg_genomes.db"
+DB_MMAP_MB = 256
+# immutable=1 lets sqlite skip locking and change detection entirely, only turn it on when the database is never
+# written while the app is running
+DB_IMMUTABLE = False
+pool_size = 8
+
+
+def connect_read_only(db_loc=DB_LOC, immutable=DB_IMMUTABLE, mmap_mb=DB_MMAP_MB):
+    """sqlite connection that can only read the genome database, memory mapping up to mmap_mb of it"""
+    uri = 'file:%s?mode=ro' % path.abspath(db_loc)
+    if immutable:
+        uri += '&immutable=1'
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute('PRAGMA mmap_size = %d' % (mmap_mb * 1024 * 1024))
+    conn.execute('PRAGMA query_only = 1')
+    return conn
+
+
+# connections are opened lazily so a gunicorn --preload master forks before any exist, each worker gets its own pool
+engine = create_engine('sqlite://', creator=connect_read_only, poolclass=QueuePool, pool_size=pool_size,
+                       max_overflow=pool_size)
 Base.metadata.bind = engine
 
 DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# one session per thread, handed back to the pool at the end of every request
+session = scoped_session(DBSession)
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    session.remove()
+
 
 # TODO: Figure out a way to add in tree distance between OTUs
 # TODO: Pathway enrichment of seeds
@@ -51,13 +91,139 @@ def pretty_taxa(taxa_str):
         return "Unclassified"
 
 
-# TODO: put this somewhere and have tree read in as a global
+tree_distance = None
+tree_lock = Lock()
+
+
+def get_tree_distance():
+    """parse the greengenes tree once per process"""
+    global tree_distance
+    if tree_distance is None:
+        with tree_lock:
+            if tree_distance is None:
+                tree_distance = TreeDistance.read(pu.get_tree_loc())
+    return tree_distance
+
+
 def get_tip2tip(otu1, otu2):
-    tree_loc = path.join(pu.get_data_dir(), 'gg_13_8_otus', 'trees', '99_otus.tree')
-    tree = TreeNode.read(tree_loc)
-    tip_a = tree.find(str(otu1))
-    tip_b = tree.find(str(otu2))
-    return tip_a.distance(tip_b)
+    return get_tree_distance().distance(otu1, otu2)
+
+
+genome_cache = None
+genome_cache_lock = Lock()
+
+
+def get_genome_cache():
+    """make the genome cache on first use so its limits can be set in app.config before then"""
+    global genome_cache
+    if genome_cache is None:
+        with genome_cache_lock:
+            if genome_cache is None:
+                # pooled connections may hold pages of the old file, so start new ones when it changes
+                genome_cache = GenomeCache(DB_LOC, app.config['GENOME_CACHE_MAX_GENOMES'],
+                                           app.config['GENOME_CACHE_MAX_MB'], on_change=engine.dispose)
+    return genome_cache
+
+
+def load_genome(name):
+    # the compiled statement is cached by sqlalchemy, only the name changes between lookups
+    genome = session.query(Genome).options(joinedload(Genome.data)).filter(Genome.name == name).one()
+    return ProcessedGenome(genome, pretty_taxa(genome.taxonomy))
+
+
+def get_genome(name):
+    """processed genome for an OTU id, raises NoResultFound if it is not in the database"""
+    return get_genome_cache().get(name, load_genome)
+
+
+pair_results = None
+pair_results_lock = Lock()
+
+
+def get_pair_results():
+    """the pair results store named in app.config, None if none is set"""
+    global pair_results
+    if pair_results is None and app.config['PAIR_RESULTS_LOC'] is not None:
+        with pair_results_lock:
+            if pair_results is None:
+                pair_results = PairResultStore(app.config['PAIR_RESULTS_LOC'])
+    return pair_results
+
+
+def get_pair_result(genome1, genome2):
+    """stored result for a pair of processed genomes, computed and stored if there isn't one"""
+    store = get_pair_results()
+    if store is not None:
+        result = store.get(genome1.name, genome1.fingerprint, genome2.name, genome2.fingerprint)
+        if result is not None:
+            return result
+    result = compute_pair_result(genome1.nodes, genome1.seed_sets, genome2.nodes, genome2.seed_sets,
+                                 get_tip2tip(genome1.name, genome2.name))
+    if store is not None:
+        try:
+            store.put(genome1.name, genome1.fingerprint, genome2.name, genome2.fingerprint, result)
+        except sqlite3.Error as e:
+            app.logger.warning("Could not store pair result for %s and %s: %s" % (genome1.name, genome2.name, e))
+    return result
+
+
+# exportable fields, the column each is read from and how it is converted for json
+EXPORT_FIELDS = {
+    'name': (Genome.name, None),
+    'taxonomy': (Genome.taxonomy, None),
+    'nsti': (Genome.nsti, None),
+    'seeds': (Genome.seeds, json.loads),
+    'genome': (GenomeData.genome, kos_to_str),
+    'metab_net': (GenomeData.metab_net, lambda metab_net: CompactGraph.from_bytes(metab_net).to_cytoscape()),
+}
+export_chunk_size = 995
+
+
+def get_list_param(key):
+    """list parameter from a json body or a comma or space separated form field, None if not given"""
+    data = request.get_json(silent=True)
+    if data is not None:
+        value = data.get(key)
+    else:
+        value = request.form.get(key)
+    if isinstance(value, str):
+        value = value.replace(',', ' ').split()
+    return None if value is None else [str(i) for i in value]
+
+
+def get_missing_otus(otu_ids):
+    """OTU ids not in the database, found from the name index alone"""
+    found = set()
+    with engine.connect() as conn:
+        for i in range(0, len(otu_ids), export_chunk_size):
+            chunk = otu_ids[i:i+export_chunk_size]
+            found.update([str(name) for name, in conn.execute(select(Genome.name).where(Genome.name.in_(chunk)))])
+    return [i for i in otu_ids if i not in found]
+
+
+def iter_genome_ndjson(otu_ids, fields):
+    """one json object per genome with only fields, read row by row and only joining genome_data when needed"""
+    columns = [EXPORT_FIELDS[field][0] for field in fields]
+    converters = [EXPORT_FIELDS[field][1] for field in fields]
+    query = select(*columns)
+    if any([column.table is GenomeData.__table__ for column in columns]):
+        query = query.select_from(Genome.__table__.join(GenomeData.__table__))
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for i in range(0, len(otu_ids), export_chunk_size):
+            chunk = otu_ids[i:i+export_chunk_size]
+            for row in conn.execute(query.where(Genome.name.in_(chunk))):
+                yield json.dumps({field: value if converter is None or value is None else converter(value)
+                                  for field, value, converter in zip(fields, row, converters)}) + '\n'
+
+
+def gzip_stream(lines):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for line in lines:
+        data = compressor.compress(line.encode())
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 @app.route('/')
@@ -70,16 +236,12 @@ def single_otu_result():
     if request.method == 'POST':
         if request.form['name']:
             try:
-                genome = session.query(Genome).filter_by(name=request.form['name']).one()
+                genome = get_genome(request.form['name'])
             except NoResultFound:
                 flash("OTU ID %s not in database." % request.form['name'])
                 return redirect(url_for('welcome_page'))
-            metab_net_json = json.loads(genome.metab_net)
-            metab_net = cy.to_networkx(metab_net_json)
-            metab_net, ss = mna.determine_seed_set(metab_net)
-            seeds = [j for i in list(ss.values()) for j in i]
-            return render_template('singleOTUResult.html', genome=genome, taxa_str=pretty_taxa(genome.taxonomy),
-                                   seeds=sorted(seeds), eles=json.dumps(metab_net_json['elements']))
+            return render_template('singleOTUResult.html', genome=genome, taxa_str=genome.taxa_str,
+                                   seeds=sorted(genome.seeds), eles=genome.eles)
         else:
             flash("No OTU ID entered for single analysis.")
             return redirect(url_for('welcome_page'))
@@ -96,55 +258,36 @@ def pair_otu_result():
             exception = False
             genome1 = None
             try:
-                genome1 = session.query(Genome).filter_by(name=request.form['name1']).one()
+                genome1 = get_genome(request.form['name1'])
             except NoResultFound:
                 flash("OTU %s not found in the database." % request.form['name1'])
                 exception = True
             genome2 = None
             try:
-                genome2 = session.query(Genome).filter_by(name=request.form['name2']).one()
+                genome2 = get_genome(request.form['name2'])
             except NoResultFound:
                 flash("OTU %s not found in the database." % request.form['name2'])
                 exception = True
             if exception:
                 return redirect(url_for('welcome_page'))
 
-            # get tree data
-            tip2tip = get_tip2tip(genome1.name, genome2.name)
-
-            # get data and determine seeds
-            metab_net1_json = json.loads(genome1.metab_net)
-            metab_net1 = cy.to_networkx(metab_net1_json)
-            metab_net2_json = json.loads(genome2.metab_net)
-            metab_net2 = cy.to_networkx(metab_net2_json)
-            metab_net1, ss1 = mna.determine_seed_set(metab_net1)
-            metab_net2, ss2 = mna.determine_seed_set(metab_net2)
-            seeds1 = set([j for i in list(ss1.values()) for j in i])
-            seeds2 = set([j for i in list(ss2.values()) for j in i])
-
-            # analyze seeds and determine metabolic characteristics
-            seeds1_only = seeds1-seeds2
-            if seeds1_only == set():
-                seeds1_only = [None]
-            seeds2_only = seeds2-seeds1
-            if seeds2_only == set():
-                seeds2_only = [None]
-            shared_seeds = seeds1 & seeds2
-            otu1_seeds_otu2_complement = seeds1_only & set(metab_net2.nodes())
-            otu2_seeds_otu1_complement = seeds2_only & set(metab_net1.nodes())
-            net1net2_bss, net2net1_bss = mna.calculate_bss(metab_net1, ss1, metab_net2, ss2)
-            net1net2_mci, net2net1_mci = mna.calculate_mci(metab_net1, ss1, metab_net2, ss2)
+            # stored pair result or one computed from the seeds stored at build time
+            result = get_pair_result(genome1, genome2)
+            seeds1_only = result['seeds1_only'] or [None]
+            seeds2_only = result['seeds2_only'] or [None]
 
             # render page
-            return render_template('pairOTUResult.html', genome1=genome1, taxa_str1=pretty_taxa(genome1.taxonomy),
-                                   seeds1=sorted(seeds1_only), eles1=json.dumps(metab_net1_json['elements']),
-                                   genome2=genome2, taxa_str2=pretty_taxa(genome2.taxonomy), seeds2=sorted(seeds2_only),
-                                   eles2=json.dumps(metab_net2_json['elements']), tip2tip=round(tip2tip, 2),
-                                   shared_seeds=sorted(shared_seeds), net1net2_bss=round(net1net2_bss, 2),
-                                   net2net1_bss=round(net2net1_bss, 2), net1net2_mci=round(net1net2_mci, 2),
-                                   net2net1_mci=round(net2net1_mci, 2),
-                                   otu1_seeds_otu2_complement=otu1_seeds_otu2_complement,
-                                   otu2_seeds_otu1_complement=otu2_seeds_otu1_complement)
+            return render_template('pairOTUResult.html', genome1=genome1, taxa_str1=genome1.taxa_str,
+                                   seeds1=seeds1_only, eles1=genome1.eles,
+                                   genome2=genome2, taxa_str2=genome2.taxa_str, seeds2=seeds2_only,
+                                   eles2=genome2.eles, tip2tip=round(result['tip2tip'], 2),
+                                   shared_seeds=result['shared_seeds'],
+                                   net1net2_bss=round(result['net1net2_bss'], 2),
+                                   net2net1_bss=round(result['net2net1_bss'], 2),
+                                   net1net2_mci=round(result['net1net2_mci'], 2),
+                                   net2net1_mci=round(result['net2net1_mci'], 2),
+                                   otu1_seeds_otu2_complement=result['otu1_seeds_otu2_complement'],
+                                   otu2_seeds_otu1_complement=result['otu2_seeds_otu1_complement'])
         else:
             flash("Need to enter two OTU ID's to compare OTUs")
             return redirect(url_for('welcome_page'))
@@ -153,18 +296,79 @@ def pair_otu_result():
         return redirect(url_for('welcome_page'))
 
 
+@app.route('/result/community/', methods=['POST'])
+def community_result():
+    otu_ids = request.form.get('otu_ids', '').replace(',', ' ').split()
+    biom_file = request.files.get('biom_file')
+    if biom_file is not None and biom_file.filename:
+        with NamedTemporaryFile(suffix='.biom') as f:
+            biom_file.save(f.name)
+            otu_ids += ca.get_otu_ids_from_biom(f.name)
+    otu_ids = list(dict.fromkeys(otu_ids))
+    if len(otu_ids) < 2:
+        abort(400, "Need at least two OTU ID's to analyze a community.")
+    try:
+        genomes = ca.get_genomes(session, otu_ids)
+    except NoResultFound as e:
+        abort(404, str(e))
+
+    community = ca.analyze_community(genomes, get_tree_distance())
+    if request.form.get('format', 'json') == 'tsv':
+        return Response(ca.iter_community_tsv(community), mimetype='text/tab-separated-values',
+                        headers={'Content-Disposition': 'attachment; filename=community.tsv'})
+    return jsonify(ca.community_to_json(community))
+
+
+@app.route('/stats/genome_cache')
+def genome_cache_stats():
+    return jsonify(get_genome_cache().stats())
+
+
+@app.route('/stats/pair_results')
+def pair_results_stats():
+    store = get_pair_results()
+    return jsonify(None if store is None else store.stats())
+
+
+@app.route('/export/', methods=['POST'])
+def export_genomes():
+    """stream genomes as newline delimited json, gzipped if the client accepts it
+
+    takes otu_ids and optionally fields, as a json body or form fields, rows come out in database order
+    """
+    otu_ids = get_list_param('otu_ids')
+    if not otu_ids:
+        abort(400, "No OTU ID's given to export.")
+    otu_ids = list(dict.fromkeys(otu_ids))
+    fields = get_list_param('fields') or list(EXPORT_FIELDS)
+    unknown = [field for field in fields if field not in EXPORT_FIELDS]
+    if len(unknown) > 0:
+        abort(400, "Unknown fields %s, choose from %s" % (', '.join(unknown), ', '.join(EXPORT_FIELDS)))
+    missing = get_missing_otus(otu_ids)
+    if len(missing) > 0:
+        abort(404, "Not all OTUs found. %s are missing" % ', '.join(missing))
+
+    lines = iter_genome_ndjson(otu_ids, fields)
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(gzip_stream(lines), mimetype='application/x-ndjson', headers=headers)
+    return Response(lines, mimetype='application/x-ndjson', headers=headers)
+
+
 @app.route('/get/<string:otu_ids>')
 def get_otu_json(otu_ids):
+    """all fields of a few genomes in one json object, use /export/ for anything large"""
     otu_ids = otu_ids.split(',')
     genome_dict = dict()
     for i in range(0, len(otu_ids), 995):
         chunk = otu_ids[i:i+995]
-        genomes = session.query(Genome).filter(Genome.name.in_(chunk))
-        if genomes.count() == len(chunk):
-            genome_dict.update({genome.name: genome.serialize for genome in genomes})
-        else:
-            found_ids = set(otu_ids) - set([i.name for i in genomes])
-            raise NoResultFound("Not all OTUs found. %s are missing" % ', '.join(found_ids))
+        genomes = session.query(Genome).options(joinedload(Genome.data)).filter(Genome.name.in_(chunk)).all()
+        genome_dict.update({genome.name: genome.serialize for genome in genomes})
+    found = set([str(name) for name in genome_dict])
+    missing = [i for i in otu_ids if i not in found]
+    if len(missing) > 0:
+        raise NoResultFound("Not all OTUs found. %s are missing" % ', '.join(missing))
     return jsonify(genome_dict)
 
 
@@ -0,0 +1,149 @@
+"""Bring an existing gg_genomes.db up to date with the current database_setup schema."""
+import argparse
+import json
+
+import networkx as nx
+from sqlalchemy import create_engine, inspect, text
+
+from database_setup import Base
+from micrometab_analysis import metabolic_network_analysis as mna
+from micrometab_analysis.compact_graph import CompactGraph
+from micrometab_analysis.kegg_ids import encode_kos
+from micrometab_analysis.ko_sets import pack_kos
+
+DB_LOC = "gg_genomes.db"
+batch_size = 1000
+
+
+def get_columns(engine, table='genomes'):
+    return set([column['name'] for column in inspect(engine).get_columns(table)])
+
+
+def add_seeds(engine, batch_size=batch_size):
+    """add the seeds column and fill it, and the Seed/SeedGroup node flags, for genomes built without them"""
+    if 'seeds' not in get_columns(engine):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE genomes ADD COLUMN seeds VARCHAR(100000)"))
+    if 'metab_net' not in get_columns(engine):
+        # networks already moved to genome_data were all built with seeds
+        return
+
+    updated = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text("SELECT id, metab_net FROM genomes WHERE seeds IS NULL "
+                                     "AND typeof(metab_net) = 'text' LIMIT :n"), {'n': batch_size}).fetchall()
+            if len(rows) == 0:
+                break
+            updates = list()
+            for genome_id, metab_net in rows:
+                metab_net_json = json.loads(metab_net)
+                nodes = metab_net_json['elements']['nodes']
+                metab_net = nx.DiGraph()
+                metab_net.add_nodes_from([node['data']['id'] for node in nodes])
+                metab_net.add_edges_from([(edge['data']['source'], edge['data']['target'])
+                                          for edge in metab_net_json['elements']['edges']])
+                metab_net, seed_sets = mna.determine_seed_set(metab_net)
+                seed_groups = {co: seed_group for seed_group, seeds in seed_sets.items() for co in seeds}
+                for node in nodes:
+                    co = node['data']['id']
+                    node['data'].update({'Seed': 1, 'SeedGroup': seed_groups[co]} if co in seed_groups else
+                                        {'Seed': 0})
+                updates.append({'id': genome_id, 'metab_net': json.dumps(metab_net_json),
+                                'seeds': json.dumps(list(seed_sets.values()))})
+            conn.execute(text("UPDATE genomes SET metab_net = :metab_net, seeds = :seeds WHERE id = :id"), updates)
+        updated += len(rows)
+        print("seeds added for %s genomes" % updated)
+
+
+def compact_metab_nets(engine, batch_size=batch_size):
+    """convert cytoscape json stored in metab_net to the compact_graph binary format"""
+    if 'metab_net' not in get_columns(engine):
+        return
+    updated = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text("SELECT id, metab_net FROM genomes WHERE typeof(metab_net) = 'text' LIMIT :n"),
+                                {'n': batch_size}).fetchall()
+            if len(rows) == 0:
+                break
+            updates = [{'id': genome_id, 'metab_net': CompactGraph.from_cytoscape(json.loads(metab_net)).to_bytes()}
+                       for genome_id, metab_net in rows]
+            conn.execute(text("UPDATE genomes SET metab_net = :metab_net WHERE id = :id"), updates)
+        updated += len(rows)
+        print("metab_net compacted for %s genomes" % updated)
+    if updated > 0:
+        # give the space freed by the json back to the filesystem
+        with engine.connect() as conn:
+            conn.execute(text("VACUUM"))
+
+
+def add_name_index(engine):
+    """drop duplicate genomes left by rerun builds, keeping the newest, then make name unique and add fingerprint"""
+    with engine.begin() as conn:
+        removed = conn.execute(text("DELETE FROM genomes WHERE id NOT IN "
+                                    "(SELECT MAX(id) FROM genomes GROUP BY name)")).rowcount
+        conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_genomes_name ON genomes (name)"))
+    if removed > 0:
+        print("removed %s duplicate genomes" % removed)
+    if 'fingerprint' not in get_columns(engine):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE genomes ADD COLUMN fingerprint VARCHAR(40)"))
+
+
+def split_genome_data(engine):
+    """move metab_net and genome out of genomes into the genome_data table, rebuilding genomes without them"""
+    if 'metab_net' not in get_columns(engine):
+        return
+    metadata_columns = ', '.join(['name', 'id', 'taxonomy', 'nsti', 'seeds', 'fingerprint'])
+    with engine.begin() as conn:
+        # keep references to genomes in genome_data pointing at the rebuilt table
+        conn.execute(text("PRAGMA legacy_alter_table = ON"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_genomes_name"))
+        conn.execute(text("ALTER TABLE genomes RENAME TO genomes_old"))
+        Base.metadata.create_all(conn)
+        conn.execute(text("INSERT INTO genomes (%s) SELECT %s FROM genomes_old" % (metadata_columns, metadata_columns)))
+        moved = conn.execute(text("INSERT OR REPLACE INTO genome_data (name, metab_net, genome) "
+                                  "SELECT name, metab_net, genome FROM genomes_old")).rowcount
+        conn.execute(text("DROP TABLE genomes_old"))
+        conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+    print("moved networks of %s genomes to genome_data" % moved)
+    with engine.connect() as conn:
+        conn.execute(text("VACUUM"))
+
+
+def pack_genomes(engine, batch_size=batch_size):
+    """convert comma joined KO lists stored in genome_data.genome to ko_sets bitsets"""
+    updated = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text("SELECT name, genome FROM genome_data WHERE typeof(genome) = 'text' LIMIT :n"),
+                                {'n': batch_size}).fetchall()
+            if len(rows) == 0:
+                break
+            updates = [{'name': name, 'genome': pack_kos(encode_kos([ko for ko in genome.split(',') if ko != '']))}
+                       for name, genome in rows]
+            conn.execute(text("UPDATE genome_data SET genome = :genome WHERE name = :name"), updates)
+        updated += len(rows)
+        print("genome packed for %s genomes" % updated)
+    if updated > 0:
+        with engine.connect() as conn:
+            conn.execute(text("VACUUM"))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--db_loc", help="location of genome database to migrate", default=DB_LOC)
+    parser.add_argument("--batch_size", help="genomes to update per transaction", type=int, default=batch_size)
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite:///%s' % args.db_loc)
+    add_name_index(engine)
+    add_seeds(engine, args.batch_size)
+    compact_metab_nets(engine, args.batch_size)
+    split_genome_data(engine)
+    pack_genomes(engine, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
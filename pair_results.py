@@ -0,0 +1,205 @@
+"""Materialized results of the pair OTU analysis: tip to tip distance, seed set differences, complements, BSS and
+MCI for a pair of genomes, kept in a SQLite file apart from the genome database.  The web app reads a pair from
+here first and writes back anything it had to compute, and running this module fills it ahead of time for a set
+of OTUs, such as the most abundant ones in a BIOM table.
+
+Each pair is stored once with the lower OTU id first and keyed on the fingerprints of both genomes, so a pair is
+recomputed after either genome is rebuilt.  Genomes built before fingerprints existed are never stored.  Results
+depend on the tree too, so clear the table with --clear after changing it.
+"""
+import argparse
+import json
+import sqlite3
+import warnings
+from threading import Lock
+
+from biom import load_table
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import community_analysis as ca
+from micrometab_analysis import metabolic_network_analysis as mna
+from micrometab_analysis import picrust_util as pu
+from micrometab_analysis.community_metrics import calculate_bss_mci_matrices
+from micrometab_analysis.tree_distance import TreeDistance
+
+DB_LOC = "gg_genomes.db"
+PAIR_RESULTS_LOC = "pair_results.db"
+chunk_size = 10000
+
+FLOAT_FIELDS = ['tip2tip', 'net1net2_bss', 'net2net1_bss', 'net1net2_mci', 'net2net1_mci']
+SEED_FIELDS = ['seeds1_only', 'seeds2_only', 'shared_seeds', 'otu1_seeds_otu2_complement',
+               'otu2_seeds_otu1_complement']
+FIELDS = FLOAT_FIELDS + SEED_FIELDS
+# the field each field becomes when otu1 and otu2 trade places
+SWAPPED = {'tip2tip': 'tip2tip', 'net1net2_bss': 'net2net1_bss', 'net2net1_bss': 'net1net2_bss',
+           'net1net2_mci': 'net2net1_mci', 'net2net1_mci': 'net1net2_mci', 'seeds1_only': 'seeds2_only',
+           'seeds2_only': 'seeds1_only', 'shared_seeds': 'shared_seeds',
+           'otu1_seeds_otu2_complement': 'otu2_seeds_otu1_complement',
+           'otu2_seeds_otu1_complement': 'otu1_seeds_otu2_complement'}
+
+
+def pair_result(nodes1, seeds1, nodes2, seeds2, tip2tip, bss, mci):
+    """everything the pair page shows about two genomes given their node sets, seed unions and scores, seed
+    lists are sorted"""
+    seeds1_only = seeds1 - seeds2
+    seeds2_only = seeds2 - seeds1
+    return {'tip2tip': tip2tip, 'net1net2_bss': bss[0], 'net2net1_bss': bss[1], 'net1net2_mci': mci[0],
+            'net2net1_mci': mci[1], 'seeds1_only': sorted(seeds1_only), 'seeds2_only': sorted(seeds2_only),
+            'shared_seeds': sorted(seeds1 & seeds2), 'otu1_seeds_otu2_complement': sorted(seeds1_only & nodes2),
+            'otu2_seeds_otu1_complement': sorted(seeds2_only & nodes1)}
+
+
+def compute_pair_result(nodes1, seed_sets1, nodes2, seed_sets2, tip2tip):
+    """pair_result for one pair, the way the pair page computes it when nothing is stored"""
+    seeds1 = set([j for i in seed_sets1.values() for j in i])
+    seeds2 = set([j for i in seed_sets2.values() for j in i])
+    bss = mna.calculate_bss_from_nodes(nodes1, seed_sets1, nodes2, seed_sets2)
+    mci = mna.calculate_mci_from_nodes(nodes1, seed_sets1, nodes2, seed_sets2)
+    return pair_result(nodes1, seeds1, nodes2, seeds2, tip2tip, bss, mci)
+
+
+def swap_result(result):
+    return {SWAPPED[field]: value for field, value in result.items()}
+
+
+class PairResultStore:
+    """pair results keyed on both OTU ids in a SQLite file safe to share between processes and threads"""
+    def __init__(self, loc=PAIR_RESULTS_LOC):
+        self.loc = loc
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(loc, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pair_results (name1 INTEGER NOT NULL, name2 INTEGER NOT NULL, "
+                          "fingerprint1 TEXT NOT NULL, fingerprint2 TEXT NOT NULL, %s, %s, "
+                          "PRIMARY KEY (name1, name2)) WITHOUT ROWID" %
+                          (', '.join(['%s REAL' % field for field in FLOAT_FIELDS]),
+                           ', '.join(['%s TEXT' % field for field in SEED_FIELDS])))
+        self.conn.commit()
+        self.select = "SELECT fingerprint1, fingerprint2, %s FROM pair_results WHERE name1 = ? AND name2 = ?" % \
+                      ', '.join(FIELDS)
+        self.insert = "INSERT OR REPLACE INTO pair_results (name1, name2, fingerprint1, fingerprint2, %s) " \
+                      "VALUES (%s)" % (', '.join(FIELDS), ', '.join('?' * (len(FIELDS) + 4)))
+
+    def get(self, name1, fingerprint1, name2, fingerprint2):
+        """stored result of otu1 against otu2, None if there is none for these builds of both genomes"""
+        swapped = name1 > name2
+        if swapped:
+            name1, fingerprint1, name2, fingerprint2 = name2, fingerprint2, name1, fingerprint1
+        with self.lock:
+            row = self.conn.execute(self.select, (name1, name2)).fetchone()
+            if row is None or fingerprint1 is None or tuple(row[:2]) != (fingerprint1, fingerprint2):
+                self.misses += 1
+                return None
+            self.hits += 1
+        result = dict(zip(FLOAT_FIELDS, row[2:2+len(FLOAT_FIELDS)]))
+        result.update(zip(SEED_FIELDS, [json.loads(i) for i in row[2+len(FLOAT_FIELDS):]]))
+        return swap_result(result) if swapped else result
+
+    def put_many(self, pairs):
+        """store (name1, fingerprint1, name2, fingerprint2, result) tuples in one transaction"""
+        rows = list()
+        for name1, fingerprint1, name2, fingerprint2, result in pairs:
+            if fingerprint1 is None or fingerprint2 is None:
+                continue
+            if name1 > name2:
+                name1, fingerprint1, name2, fingerprint2 = name2, fingerprint2, name1, fingerprint1
+                result = swap_result(result)
+            rows.append([name1, name2, fingerprint1, fingerprint2] + [result[field] for field in FLOAT_FIELDS] +
+                        [json.dumps(result[field]) for field in SEED_FIELDS])
+        with self.lock, self.conn:
+            self.conn.executemany(self.insert, rows)
+
+    def put(self, name1, fingerprint1, name2, fingerprint2, result):
+        self.put_many([(name1, fingerprint1, name2, fingerprint2, result)])
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM pair_results")
+
+    def stats(self):
+        with self.lock:
+            pairs, = self.conn.execute("SELECT count(*) FROM pair_results").fetchone()
+            return {'pairs': pairs, 'hits': self.hits, 'misses': self.misses, 'loc': self.loc}
+
+    def close(self):
+        self.conn.close()
+
+
+def get_top_otus(biom_loc, top):
+    """the top most abundant OTUs summed over all samples of a BIOM table, most abundant first"""
+    table = load_table(biom_loc)
+    totals = table.sum(axis='observation')
+    otus = [str(i) for i in table.ids(axis='observation')]
+    order = sorted(range(len(otus)), key=lambda i: -totals[i])
+    return [otus[i] for i in order[:top]]
+
+
+def iter_pair_results(genomes, tree_distance, block_size=ca.block_size, nprocs=ca.procs):
+    """(name1, fingerprint1, name2, fingerprint2, result) for every unordered pair of genomes, with BSS and MCI of
+    the whole set found at once by community_metrics"""
+    otus = [str(genome.name) for genome in genomes]
+    nodes = [genome.metab_graph.node_set() for genome in genomes]
+    seed_sets = [genome.seed_sets for genome in genomes]
+    seeds = [set([j for i in genome_seed_sets.values() for j in i]) for genome_seed_sets in seed_sets]
+    bss, mci = calculate_bss_mci_matrices(nodes, seed_sets, block_size, nprocs)
+    tip2tip = tree_distance.distance_matrix(otus)
+    for i, genome1 in enumerate(genomes):
+        for j in range(i + 1, len(genomes)):
+            genome2 = genomes[j]
+            result = pair_result(nodes[i], seeds[i], nodes[j], seeds[j], float(tip2tip[i, j]),
+                                 (float(bss[i, j]), float(bss[j, i])), (float(mci[i, j]), float(mci[j, i])))
+            yield genome1.name, genome1.fingerprint, genome2.name, genome2.fingerprint, result
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="precompute pair OTU results for every pair in a set of OTUs")
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--otu_ids", help="comma separated list of OTU ids")
+    input_group.add_argument("--biom_loc", help="BIOM OTU table, the --top most abundant observations are used")
+    parser.add_argument("--top", help="number of OTUs to take from --biom_loc", type=int, default=1000)
+    parser.add_argument("--db_loc", help="location of genome database", default=DB_LOC)
+    parser.add_argument("--pair_results_loc", help="location of pair results database", default=PAIR_RESULTS_LOC)
+    parser.add_argument("--tree_loc", help="location of greengenes tree", default=pu.get_tree_loc())
+    parser.add_argument("--clear", help="remove all stored pairs first", action="store_true", default=False)
+    parser.add_argument("--nprocs", help="number of processors", type=int, default=ca.procs)
+    parser.add_argument("--block_size", help="OTUs compared against the set at a time", type=int,
+                        default=ca.block_size)
+    args = parser.parse_args()
+
+    if args.otu_ids is not None:
+        otu_ids = [i.strip() for i in args.otu_ids.split(',') if len(i.strip()) > 0]
+    else:
+        otu_ids = get_top_otus(args.biom_loc, args.top)
+    otu_ids = list(dict.fromkeys(otu_ids))
+
+    session = sessionmaker(bind=create_engine('sqlite:///%s' % args.db_loc))()
+    genomes = ca.get_genomes(session, otu_ids, skip_missing=True)
+    if len(genomes) < len(otu_ids):
+        found = set([str(genome.name) for genome in genomes])
+        missing = [i for i in otu_ids if i not in found]
+        warnings.warn("%s OTUs not in the genome database are skipped: %s" % (len(missing), ', '.join(missing)))
+
+    store = PairResultStore(args.pair_results_loc)
+    if args.clear:
+        store.clear()
+    pairs = list()
+    n_pairs = 0
+    for pair in iter_pair_results(genomes, TreeDistance.read(args.tree_loc), args.block_size, args.nprocs):
+        pairs.append(pair)
+        if len(pairs) == chunk_size:
+            store.put_many(pairs)
+            n_pairs += len(pairs)
+            pairs = list()
+    store.put_many(pairs)
+    n_pairs += len(pairs)
+    print("%s pairs of %s OTUs stored in %s" % (n_pairs, len(genomes), args.pair_results_loc))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,34 @@
 import argparse
+import gc
+import hashlib
 import json
 import multiprocessing
 import os
+import time
+import warnings
 from datetime import datetime
+from functools import partial
 
+import numpy as np
 import requests
-from py2cytoscape import util as cy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects.sqlite import insert
 
-from database_setup import Base, Genome
+from database_setup import Base, Genome, GenomeData
 from micrometab_analysis import metabolic_network_analysis as mna
+from micrometab_analysis import parse_KEGG
+from micrometab_analysis import picrust_util
+from micrometab_analysis.kegg_ids import encode_kos
+from micrometab_analysis.ko_sets import pack_kos
 from micrometab_analysis.picrust_util import load_data_table
 
-engine = create_engine('sqlite:///gg_genomes.db')
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-
-session = DBSession()
-
-
 GG_LOC = "/Users/shafferm/lab/HIV_5runs/qiime_files/99_otu_taxonomy.txt"
 KEGG_LOC = "/Users/shafferm/KEGG_late_june2011_snapshot/"
-chunk_size = 10000
+DB_LOC = "gg_genomes.db"
+# bump when the way genomes are built changes so --rebuild_changed redoes everything
+BUILD_VERSION = 1
+chunk_size = 500
+commit_size = 5000
 procs = 3
 
 
@@ -55,41 +61,119 @@ def breakup_list(l, n):
         yield l[i:i + n]
 
 
-def generate_genome_local(otus, loc=None):
+def get_input_fingerprint(kegg_loc):
+    """hash of the inputs shared by every genome: build version, KEGG files and compounds filtered from networks"""
+    parse_KEGG.KEGGParser(kegg_loc)
+    # by content, so touching or moving the KEGG directory does not rebuild every genome
+    inputs = [BUILD_VERSION, parse_KEGG.CACHE_VERSION, parse_KEGG.get_content_hash(parse_KEGG.get_ko2rxns),
+              parse_KEGG.get_content_hash(parse_KEGG.get_reactions)]
+    if os.path.exists(mna.COS_TO_REMOVE_LOC):
+        with open(mna.COS_TO_REMOVE_LOC, 'rb') as f:
+            inputs.append(hashlib.sha1(f.read()).hexdigest())
+    return hashlib.sha1(repr(inputs).encode()).hexdigest()
+
+
+def get_genome_fingerprint(input_fingerprint, taxonomy, nsti, genome):
+    """hash of everything a single genome is built from"""
+    return hashlib.sha1('\t'.join([input_fingerprint, taxonomy, str(nsti), ','.join(genome)]).encode()).hexdigest()
+
+
+def generate_genome_local(otus, loc=None, input_fingerprint=''):
+    """Build genomes for a chunk of (otu_id, taxonomy, fingerprint) tuples, where fingerprint is the one stored for
+    the OTU or None if it is not in the database.  OTUs whose inputs still match their stored fingerprint are
+    skipped.  Returns the number of OTUs in the chunk and the built genomes as row dictionaries for the genomes
+    table.
+    """
     genome_table = load_data_table([i[0] for i in otus])
+    ko_ids = np.asarray(genome_table.ids(axis="observation"), dtype='U')
+    is_ko = np.char.startswith(ko_ids, 'K')
+    for ko in ko_ids[~is_ko].tolist():
+        warnings.warn("KO id " + ko + " doesn't exist in this set.")
+    ko_codes = np.zeros(len(ko_ids), dtype=np.uint32)
+    ko_codes[is_ko] = encode_kos(ko_ids[is_ko])
+    # one column of KO counts per OTU, only the KOs present are stored
+    ko_counts = genome_table.matrix_data.tocsc()
+    ko_counts.sort_indices()
     genomes = list()
-    for otu_id, taxonomy in otus:
-        print(os.getpid(), otu_id)
+    for otu_id, taxonomy, old_fingerprint in otus:
         nsti = genome_table.metadata(otu_id)['NSTI']
-        genome = genome_table.ids(axis="observation")[genome_table.data(otu_id) > 0]
-        genome = [str(i) for i in genome]
-        print(os.getpid(), otu_id, "genome length", len(genome))
-        reactome = mna.get_reactome_local(genome, loc)
-        print(os.getpid(), otu_id, "reactome length", len(reactome))
-        rxns = mna.get_rxns_local(reactome, loc)
-        print(os.getpid(), otu_id, "reaction count", len(rxns))
-        metab_network = mna.make_metabolic_network(rxns, only_giant=True)
-        print(os.getpid(), otu_id, "network made")
-        metab_network_json = cy.from_networkx(metab_network)
-        genome = Genome(name=int(otu_id), nsti=float(nsti), metab_net=json.dumps(metab_network_json),
-                        genome=','.join(genome), taxonomy=taxonomy)
-        genomes.append(genome)
-    return genomes
-
-
-def add_chunk_to_db(chunk):
-    for genome in chunk:
-        session.add(genome)
-        session.commit()
-        print(genome.name)
-
-
-def add_chunks_to_db(chunks):
-    for chunk in chunks:
-        for genome in chunk:
-            session.add(genome)
-            session.commit()
-            print(genome.name)
+        column = genome_table.index(otu_id, axis="sample")
+        start, stop = ko_counts.indptr[column], ko_counts.indptr[column + 1]
+        rows = ko_counts.indices[start:stop][ko_counts.data[start:stop] > 0]
+        fingerprint = get_genome_fingerprint(input_fingerprint, taxonomy, nsti, ko_ids[rows].tolist())
+        if fingerprint == old_fingerprint:
+            continue
+        kos = ko_codes[rows[is_ko[rows]]]
+        metab_network = mna.make_compact_network_from_kos(kos, mna.get_ko_edge_index(loc), only_giant=True)
+        genomes.append({'name': int(otu_id), 'nsti': float(nsti), 'taxonomy': taxonomy, 'genome': pack_kos(kos),
+                        'metab_net': metab_network, 'fingerprint': fingerprint})
+    # seeds never change once the network is built so store them with the network, found for the whole chunk at once
+    mna.find_seeds_batch([genome['metab_net'] for genome in genomes])
+    for genome in genomes:
+        genome['seeds'] = json.dumps(list(genome['metab_net'].seed_sets().values()))
+        genome['metab_net'] = genome['metab_net'].to_bytes()
+    return len(otus), genomes
+
+
+def get_built_fingerprints(engine):
+    """fingerprint of every genome already in the database keyed by OTU id"""
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT name, fingerprint FROM genomes"))
+        return {str(name): fingerprint for name, fingerprint in rows}
+
+
+def get_engine(db_loc):
+    """engine for the single writer, with WAL so readers are not blocked while a build is running"""
+    engine = create_engine('sqlite:///%s' % db_loc)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def upsert(table, rows):
+    """insert statement for rows replacing any already in table for the same OTU"""
+    stmt = insert(table)
+    updates = {column: stmt.excluded[column] for column in rows[0] if column != 'name'}
+    return stmt.on_conflict_do_update(index_elements=['name'], set_=updates)
+
+
+def write_genomes(engine, genomes):
+    """insert genome rows, replacing any already built for the same OTU, with one executemany per table in one
+    transaction.  Columns of the genome_data table are split out of each row."""
+    if len(genomes) > 0:
+        data_columns = GenomeData.__table__.columns.keys()
+        genome_rows = [{column: value for column, value in genome.items()
+                        if column == 'name' or column not in data_columns} for genome in genomes]
+        data_rows = [{column: genome[column] for column in data_columns} for genome in genomes]
+        with engine.begin() as conn:
+            conn.execute(upsert(Genome.__table__, genome_rows), genome_rows)
+            conn.execute(upsert(GenomeData.__table__, data_rows), data_rows)
+
+
+class BuildProgress:
+    """prints OTUs done, throughput and time remaining at most once every interval seconds"""
+    def __init__(self, total, interval=10):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def update(self, n):
+        self.done += n
+        now = time.time()
+        if now - self.last_report >= self.interval or self.done == self.total:
+            self.last_report = now
+            rate = self.done / max(now - self.start, 1e-9)
+            remaining = (self.total - self.done) / rate if rate > 0 else float('inf')
+            print("%s/%s OTUs done, %.1f OTUs/s, %.0fs remaining" % (self.done, self.total, rate, remaining))
 
 
 def main():
@@ -99,6 +183,11 @@ def main():
     parser.add_argument("--nprocs", help="number of processors", type=int, default=procs)
     parser.add_argument("--chunk_size", help="size of chunks to analyze per processor", type=int, default=chunk_size)
     parser.add_argument("--subset", help="size of subset of gg_genomes to analyze", type=int)
+    parser.add_argument("--db_loc", help="location of genome database to write", default=DB_LOC)
+    parser.add_argument("--commit_size", help="genomes to insert per transaction", type=int, default=commit_size)
+    parser.add_argument("--rebuild_changed", help="also rebuild genomes already in the database whose KEGG, "
+                                                  "precalculated table or cos_to_remove.txt inputs changed",
+                        action='store_true')
     args = parser.parse_args()
 
     start = datetime.now()
@@ -109,13 +198,42 @@ def main():
         gg_genomes = {i.strip().split('\t')[0]: i.strip().split('\t')[1]
                       for i in open(args.gg_loc).readlines()[:args.subset]}
 
-    chunks = breakup_list(list(gg_genomes.items()), args.chunk_size)
+    # open the indexed precalculated table before forking so workers share its index and mapped pages, nothing is
+    # opened if there is no index or the table changed since it was indexed
+    picrust_util.get_indexed_table(picrust_util.get_precalc_fp())
+
+    engine = get_engine(args.db_loc)
+    # every committed genome is a checkpoint, by default a rerun only builds OTUs that are not in the database yet
+    built = get_built_fingerprints(engine)
+    if args.rebuild_changed:
+        otus = [(otu_id, taxonomy, built.get(otu_id)) for otu_id, taxonomy in gg_genomes.items()]
+    else:
+        otus = [(otu_id, taxonomy, None) for otu_id, taxonomy in gg_genomes.items() if otu_id not in built]
+    print("%s of %s OTUs to check or build" % (len(otus), len(gg_genomes)))
+    input_fingerprint = get_input_fingerprint(args.database_loc)
+
+    progress = BuildProgress(len(otus))
+    chunks = breakup_list(otus, args.chunk_size)
+    # the KO edge index is built or refreshed and mapped here, once, and inherited by every worker
+    mna.load_for_workers(args.database_loc)
     pool = multiprocessing.Pool(args.nprocs)
-    # pool.map_async(generate_genome, chunks, callback=add_chunks_to_db)
-    for chunk in chunks:
-        pool.apply_async(generate_genome_local, (chunk, args.database_loc), callback=add_chunk_to_db)
-    pool.close()
-    pool.join()
+    # the workers have forked with the frozen objects, this process can collect them again
+    gc.unfreeze()
+    # workers stream finished chunks back and this process is the only one writing to the database
+    to_write = list()
+    worker = partial(generate_genome_local, loc=args.database_loc, input_fingerprint=input_fingerprint)
+    try:
+        for n_otus, genomes in pool.imap_unordered(worker, chunks):
+            to_write.extend(genomes)
+            if len(to_write) >= args.commit_size:
+                write_genomes(engine, to_write)
+                to_write = list()
+            progress.update(n_otus)
+    finally:
+        # if a worker fails the genomes already built are still written, so a rerun starts after them
+        pool.terminate()
+        pool.join()
+        write_genomes(engine, to_write)
 
     finish = datetime.now()
     print(finish-start)
@@ -0,0 +1,226 @@
+"""Pairwise competition (MCI), complementarity (BSS) and tip to tip distance for the OTUs that co-occur in a BIOM
+OTU table, written as a gzipped TSV.
+
+    sample mode: every ordered pair of OTUs present in each sample, one set of rows per sample
+    table mode: every ordered pair of OTUs present together in at least one sample, with how many samples that is
+
+Work is split into units, samples or blocks of OTUs, spread over a process pool and each written as its own gzip
+member as soon as it is done, so the output can be read with gzip or zcat while it grows.  A checkpoint file next
+to the output records every unit written and the output size after it, and a rerun with the same arguments
+truncates anything written after the last checkpoint and only does the units not yet done.
+"""
+import argparse
+import gzip
+import multiprocessing
+import os
+import sys
+import warnings
+
+import numpy as np
+from biom import load_table
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import community_analysis as ca
+from micrometab_analysis import picrust_util as pu
+from micrometab_analysis.community_metrics import CommunityEncoding
+from micrometab_analysis.tree_distance import TreeDistance
+
+DB_LOC = "gg_genomes.db"
+HEADERS = {'sample': ['sample', 'otu1', 'otu2', 'tip2tip', 'bss', 'mci'],
+           'table': ['otu1', 'otu2', 'n_samples', 'tip2tip', 'bss', 'mci']}
+CHECKPOINT_SUFFIX = '.checkpoint'
+block_size = 500
+procs = 3
+
+community = None
+
+
+class Community:
+    """what every worker needs: encodings of the genomes in the table, the tree and which OTUs are in which
+    samples, as a genome by sample presence matrix"""
+    def __init__(self, genomes, tree_distance, presence):
+        self.otus = [str(genome.name) for genome in genomes]
+        self.encoding = CommunityEncoding([genome.metab_graph.node_set() for genome in genomes],
+                                          [genome.seed_sets for genome in genomes])
+        self.tree_distance = tree_distance
+        self.presence = presence.tocsr()
+        self.presence_csc = presence.tocsc()
+
+    def sample_members(self, sample):
+        """positions of the genomes present in a sample, in order"""
+        start, stop = self.presence_csc.indptr[sample], self.presence_csc.indptr[sample + 1]
+        return np.sort(self.presence_csc.indices[start:stop])
+
+    def sample_lines(self, sample, sample_id):
+        members = self.sample_members(sample)
+        otus = [self.otus[i] for i in members]
+        bss, mci = self.encoding.subset_metrics(members)
+        tip2tip = self.tree_distance.distance_matrix(otus)
+        rows, cols = np.nonzero(~np.eye(len(members), dtype=bool))
+        return ['%s\t%s\t%s\t%r\t%r\t%r\n' % (sample_id, otus[i], otus[j], dist, bss_ij, mci_ij)
+                for i, j, dist, bss_ij, mci_ij in zip(rows.tolist(), cols.tolist(), tip2tip[rows, cols].tolist(),
+                                                      bss[rows, cols].tolist(), mci[rows, cols].tolist())]
+
+    def block_lines(self, start, stop):
+        co_occurrence = (self.presence[start:stop] @ self.presence.T).tocoo()
+        pairs = co_occurrence.row + start != co_occurrence.col
+        rows, cols = co_occurrence.row[pairs], co_occurrence.col[pairs]
+        order = np.lexsort((cols, rows))
+        rows, cols, n_samples = rows[order], cols[order], co_occurrence.data[pairs][order]
+        bss, mci = self.encoding.block_metrics(start, stop)
+        tip2tip = self.tree_distance.distances([(self.otus[i + start], self.otus[j]) for i, j in zip(rows, cols)])
+        return ['%s\t%s\t%d\t%r\t%r\t%r\n' % (self.otus[i + start], self.otus[j], n, dist, bss_ij, mci_ij)
+                for i, j, n, dist, bss_ij, mci_ij in zip(rows.tolist(), cols.tolist(), n_samples.tolist(),
+                                                         tip2tip.tolist(), bss[rows, cols].tolist(),
+                                                         mci[rows, cols].tolist())]
+
+
+def _init_worker(worker_community):
+    global community
+    community = worker_community
+
+
+def compute_unit(unit):
+    """gzip member with the rows of a unit, ('sample', index, id) or ('block', start, stop)"""
+    kind, i, j = unit
+    lines = community.sample_lines(i, j) if kind == 'sample' else community.block_lines(i, j)
+    return unit, gzip.compress(''.join(lines).encode(), 6)
+
+
+def get_unit_name(unit):
+    kind, i, j = unit
+    return str(j) if kind == 'sample' else '%s-%s' % (i, j)
+
+
+def get_units(mode, sample_ids, n_genomes, block_size=block_size):
+    if mode == 'sample':
+        return [('sample', i, sample_id) for i, sample_id in enumerate(sample_ids)]
+    return [('block', start, min(start + block_size, n_genomes)) for start in range(0, n_genomes, block_size)]
+
+
+def get_layout(mode, block_size=block_size):
+    """what decides the units, a checkpoint can only be resumed with the same layout"""
+    return mode if mode == 'sample' else '%s:%s' % (mode, block_size)
+
+
+def read_checkpoint(output_loc, layout):
+    """complete lines of the checkpoint, None if there is nothing to resume"""
+    try:
+        with open(output_loc + CHECKPOINT_SUFFIX) as f:
+            lines = [line.rstrip('\n').split('\t') for line in f if line.endswith('\n')]
+    except IOError:
+        return None
+    if len(lines) == 0 or not os.path.exists(output_loc):
+        return None
+    if lines[0][:2] != ['#layout', layout]:
+        raise ValueError("%s was written with layout %s, not %s, use --restart to start over" %
+                         (output_loc, lines[0][1], layout))
+    return lines
+
+
+class CheckpointedOutput:
+    """gzip members appended to output_loc, each recorded with the output size after it once it is on disk"""
+    def __init__(self, output_loc, mode, layout, resume=True):
+        checkpoint = read_checkpoint(output_loc, layout) if resume else None
+        self.out = open(output_loc, 'r+b' if checkpoint is not None else 'wb')
+        self.checkpoint = open(output_loc + CHECKPOINT_SUFFIX, 'w')
+        if checkpoint is None:
+            self.done = set()
+            self.out.write(gzip.compress(('\t'.join(HEADERS[mode]) + '\n').encode(), 6))
+            self.commit('#layout\t%s' % layout)
+        else:
+            self.done = set([name for name, _ in checkpoint[1:]])
+            size = int(checkpoint[-1][-1])
+            # anything after the last checkpoint is from a unit that never finished, rewriting the checkpoint drops
+            # a line cut off part way
+            self.out.truncate(size)
+            self.checkpoint.writelines(['\t'.join(line) + '\n' for line in checkpoint])
+            self.checkpoint.flush()
+            self.out.seek(size)
+
+    def commit(self, name):
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.checkpoint.write('%s\t%s\n' % (name, self.out.tell()))
+        self.checkpoint.flush()
+
+    def write(self, name, member):
+        self.out.write(member)
+        self.commit(name)
+        self.done.add(name)
+
+    def close(self):
+        self.out.close()
+        self.checkpoint.close()
+
+
+def iter_units(community, units, nprocs=procs):
+    """(unit, gzip member) for units, in order of completion"""
+    if nprocs == 1:
+        _init_worker(community)
+        for unit in units:
+            yield compute_unit(unit)
+    else:
+        pool = multiprocessing.Pool(nprocs, initializer=_init_worker, initargs=(community,))
+        try:
+            for result in pool.imap_unordered(compute_unit, units):
+                yield result
+        except BaseException:
+            # units still queued when writing fails or the run is interrupted are redone on resume, not waited for
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+
+def load_community(biom_loc, db_loc, tree_loc):
+    """Community of the OTUs of a BIOM table that are in the genome database, and the table's sample ids"""
+    table = load_table(biom_loc)
+    otu_ids = [str(i) for i in table.ids(axis='observation')]
+    session = sessionmaker(bind=create_engine('sqlite:///%s' % db_loc))()
+    genomes = ca.get_genomes(session, otu_ids, skip_missing=True)
+    if len(genomes) < len(otu_ids):
+        warnings.warn("%s of %s OTUs are not in the genome database and are skipped" %
+                      (len(otu_ids) - len(genomes), len(otu_ids)))
+    row_index = {otu: i for i, otu in enumerate(otu_ids)}
+    presence = table.matrix_data.tocsr()[[row_index[str(genome.name)] for genome in genomes]]
+    presence.data = (presence.data > 0).astype(np.float64)
+    presence.eliminate_zeros()
+    session.close()
+    return Community(genomes, TreeDistance.read(tree_loc), presence), [str(i) for i in table.ids(axis='sample')]
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument("--biom_loc", help="BIOM OTU table", required=True)
+    parser.add_argument("--output", help="gzipped TSV to write, a .checkpoint file is kept next to it",
+                        required=True)
+    parser.add_argument("--mode", help="pairs within each sample or pairs co-occurring anywhere in the table",
+                        choices=["sample", "table"], default="sample")
+    parser.add_argument("--db_loc", help="location of genome database", default=DB_LOC)
+    parser.add_argument("--tree_loc", help="location of greengenes tree", default=pu.get_tree_loc())
+    parser.add_argument("--nprocs", help="number of processors", type=int, default=procs)
+    parser.add_argument("--block_size", help="OTUs per unit of work in table mode", type=int, default=block_size)
+    parser.add_argument("--restart", help="start over instead of resuming from the checkpoint", action="store_true",
+                        default=False)
+    args = parser.parse_args()
+
+    community, sample_ids = load_community(args.biom_loc, args.db_loc, args.tree_loc)
+    output = CheckpointedOutput(args.output, args.mode, get_layout(args.mode, args.block_size),
+                                resume=not args.restart)
+    units = [unit for unit in get_units(args.mode, sample_ids, len(community.otus), args.block_size)
+             if get_unit_name(unit) not in output.done]
+    print("%s units to do, %s already done" % (len(units), len(output.done)), file=sys.stderr)
+    try:
+        for unit, member in iter_units(community, units, args.nprocs):
+            output.write(get_unit_name(unit), member)
+    finally:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
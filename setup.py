@@ -8,7 +8,9 @@ __author__ = "shafferm"
 setup(
     name='micrometab_kb',
     version='0.1',
-    install_requires=["requests", "flask", "py2cytoscape", "sqlalchemy", "networkx", "biom-format"],
+    install_requires=["requests", "flask", "sqlalchemy", "networkx", "biom-format", "numpy", "scipy",
+                      "scikit-bio"],
+    extras_require={"remote": ["aiohttp"]},
     packages=find_packages(),
     url='https://github.com/shafferm/micrometab_KB/',
     license='BSD',